@@ -3,10 +3,12 @@ from telegram import (
 )
 from telegram.ext import ContextTypes
 from redis_config import redis_client as redis
-from redis_config.redis_helpers import get_reservation_by_id,update_reservation_status,  delete_reservation_by_id, get_user_data, get_iikoId_by_id
-from iiko_token.update_token import update_iiko_token
-from bot.reminder_mes import schedule_reservation_reminders
-import json, os, httpx, uuid
+from redis_config.redis_helpers import get_reservation_by_id, get_user_data, get_reservations_by_status, count_reservations_by_status, get_reservation_rank
+from iiko_client.client import iiko_client
+from iiko_client.workload_cache import workload_cache
+from bot.reservation_jobs import reservation_jobs
+from bot.rate_limiter import PRIORITY_ADMIN, PRIORITY_BULK
+import hashlib, json, os
 from datetime import datetime
 from dotenv import load_dotenv
 
@@ -15,22 +17,52 @@ load_dotenv()
 redis  = redis.redis_client
 
 
-def is_admin(user_id) -> bool:
-    admin_ids = os.getenv("ADMIN_IDS", "")
-    admin_ids = [int(x) for x in admin_ids.split(",") if x]
-    return user_id in admin_ids
-
-async def get_all_reservations() -> list[dict]:
-    ids = await redis.lrange("reservation:requests", 0, -1)
-
-    result = []
-    for res_id in ids:
-        data = await redis.get(f"reservation:request:{res_id}")
-        if data:
-            result.append(json.loads(data))
+def get_admin_ids() -> list[int]:
+    return [int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x]
 
-    return result
+def is_admin(user_id) -> bool:
+    return user_id in get_admin_ids()
+
+# Открытые у админов списки заявок: admin_id -> {chat_id, message_id, page}.
+# Пишут их воркеры, принявшие нажатие, а обновляет AdminViewRefresher в main.py, поэтому
+# они в Redis, а не в bot_data процесса. Отрисованный digest - отдельным полем
+# "{message_id}:{page}:{digest}": запоздалая запись digest старого сообщения не совпадёт с новым
+ADMIN_VIEWS_KEY = "admin:views"
+ADMIN_VIEW_DIGESTS_KEY = "admin:views:digest"
+
+def markup_digest(markup: InlineKeyboardMarkup) -> str:
+    return hashlib.sha1(json.dumps(markup.to_dict(), sort_keys=True).encode()).hexdigest()
+
+def view_digest(view: dict, digest: str) -> str:
+    return f"{view['message_id']}:{view['page']}:{digest}"
+
+async def save_admin_view(admin_id: int, view: dict, digest: str):
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.hset(ADMIN_VIEWS_KEY, admin_id, json.dumps(view))
+        pipe.hset(ADMIN_VIEW_DIGESTS_KEY, admin_id, view_digest(view, digest))
+        await pipe.execute()
+
+async def drop_admin_view(admin_id: int):
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.hdel(ADMIN_VIEWS_KEY, admin_id)
+        pipe.hdel(ADMIN_VIEW_DIGESTS_KEY, admin_id)
+        await pipe.execute()
+
+async def get_admin_views(admin_ids: list[int]) -> list[tuple[int, dict, str | None]]:
+    if not admin_ids:
+        return []
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.hmget(ADMIN_VIEWS_KEY, admin_ids)
+        pipe.hmget(ADMIN_VIEW_DIGESTS_KEY, admin_ids)
+        views, digests = await pipe.execute()
+    return [
+        (admin_id, json.loads(view), digest)
+        for admin_id, view, digest in zip(admin_ids, views, digests)
+        if view
+    ]
 
+async def set_admin_view_digest(admin_id: int, view: dict, digest: str):
+    await redis.hset(ADMIN_VIEW_DIGESTS_KEY, admin_id, view_digest(view, digest))
 
 async def admin_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
@@ -43,42 +75,45 @@ async def admin_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup= markup
     )
 
-async def update_admin_list(application, view):
-        reservations = await get_all_reservations()
-        not_confimed_reservations = [r for r in reservations if r["status"] != "CONFIRMED"]
-
-        per_page = 5
-        page = view["page"]
-
-        start = page * per_page
-        end = start + per_page
-        page_items = not_confimed_reservations[start:end]
-
-        keyboard = []
-        for index, r in enumerate(page_items, start=start):
-            button_text = f"👤 {r['name']}\n📞 {r['phone']}"
-            keyboard.append([
-                InlineKeyboardButton(
-                    button_text,
-                    callback_data=f"reservation:{r['id']}:{index}"
-                )
-            ])
-
-        if not page_items:
-            keyboard.append([InlineKeyboardButton("❌ Заявок нет", callback_data="noop")])
-
-        total_pages = (len(not_confimed_reservations) + per_page - 1) // per_page
-        pagination = build_pagination_keyboard(page, total_pages)
-        if pagination.inline_keyboard:
-            keyboard.extend(pagination.inline_keyboard)
-
-        await application.bot.edit_message_text(
-            chat_id=view["chat_id"],
-            message_id=view["message_id"],
-            text="📋 Заявки:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
- 
+ADMIN_PAGE_SIZE = 5
+
+async def build_admin_page(page: int) -> InlineKeyboardMarkup:
+    start = page * ADMIN_PAGE_SIZE
+    end = start + ADMIN_PAGE_SIZE - 1
+
+    # Читаем из индекса только одну страницу, ZCARD - готовый счётчик заявок
+    page_items = await get_reservations_by_status("PENDING", start, end)
+    total = await count_reservations_by_status("PENDING")
+
+    keyboard = []
+    for index, r in enumerate(page_items, start=start):
+        button_text = f"👤 {r['name']}\n📞 {r['phone']}"
+        keyboard.append([
+            InlineKeyboardButton(
+                button_text,
+                callback_data=f"reservation:{r['id']}:{index}"
+            )
+        ])
+
+    if not page_items:
+        keyboard.append([InlineKeyboardButton("❌ Заявок нет", callback_data="noop")])
+
+    total_pages = (total + ADMIN_PAGE_SIZE - 1) // ADMIN_PAGE_SIZE
+    pagination = build_pagination_keyboard(page, total_pages)
+    if pagination.inline_keyboard:
+        keyboard.extend(pagination.inline_keyboard)
+
+    return InlineKeyboardMarkup(keyboard)
+
+async def update_admin_list(application, view, markup: InlineKeyboardMarkup | None = None):
+    await application.bot.edit_message_text(
+        chat_id=view["chat_id"],
+        message_id=view["message_id"],
+        text="📋 Заявки:",
+        reply_markup=markup or await build_admin_page(view["page"]),
+        rate_limit_args={"priority": PRIORITY_BULK}
+    )
+
 def build_pagination_keyboard(current_page, total_pages):
     keyboard = []
     buttons = []
@@ -102,49 +137,42 @@ async def admin_pagination_callback(update: Update, context: ContextTypes.DEFAUL
     if query.data.startswith("page:"):
         page = int(query.data.split(":")[1])
 
-    reservations = await get_all_reservations()
-    not_confimed_reservations = [r for r in reservations if r["status"] != "CONFIRMED"]
-    per_page = 5
-
-    start = page * per_page
-    end = start + per_page
-    page_items = not_confimed_reservations[start:end]
-
-
-    keyboard = []
-    for index,  r in enumerate(page_items, start=start):
-        button_text = f"👤 {r['name']}\n 📞 {r['phone']}"
-        keyboard.append([
-            InlineKeyboardButton(
-                button_text,
-                callback_data=f"reservation:{r['id']}:{index}"
-            )
-        ])
-
-    if not page_items:
-            keyboard.append([
-        InlineKeyboardButton("❌ Заявок нет", callback_data="noop")
-    ])
-            
-    total_pages = (len(not_confimed_reservations) + per_page - 1) // per_page
-    pagination = build_pagination_keyboard(page, total_pages)
-
-    if pagination.inline_keyboard:
-        keyboard.extend(pagination.inline_keyboard)
-
-
-    await query.edit_message_text(
+    markup = await build_admin_page(page)
+    message = await query.edit_message_text(
         text="📋 Заявки:",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=markup
     )
 
-async def view_reservation(update: Update, context: ContextTypes.DEFAULT_TYPE, reservation_id, index):
-    reservations = await get_all_reservations()
-    not_confimed_reservations = [r for r in reservations if r["status"] != "CONFIRMED"]
+    # запоминаем открытый список, чтобы обновлять его при новых заявках
+    await save_admin_view(query.from_user.id, {
+        "chat_id": message.chat_id,
+        "message_id": message.message_id,
+        "page": page
+    }, markup_digest(markup))
 
-    total = len(not_confimed_reservations)
+async def view_reservation(update: Update, context: ContextTypes.DEFAULT_TYPE, reservation_id, index):
+    # админ ушёл в карточку заявки - список в этом сообщении больше не обновляем
+    await drop_admin_view(update.callback_query.from_user.id)
+
+    # Пока админ листал, очередь могла сдвинуться - настоящую позицию берём из индекса
+    rank = await get_reservation_rank("PENDING", reservation_id)
+    if rank is not None:
+        index = rank
+
+    start = max(index - 1, 0)
+    window = await get_reservations_by_status("PENDING", start, index + 1)
+    total = await count_reservations_by_status("PENDING")
+
+    position = index - start
+    if position >= len(window):
+        await update.callback_query.edit_message_text(
+            text="❌ Заявка не найдена",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("📋 К списку", callback_data="view_reservations")]])
+        )
+        return
 
-    data = not_confimed_reservations[index]
+    data = window[position]
+    reservation_id = data["id"]
 
     text = (
         f"📋 Заявка {index + 1} из {total}\n\n"
@@ -157,8 +185,8 @@ async def view_reservation(update: Update, context: ContextTypes.DEFAULT_TYPE, r
 
     nav_buttons = []
 
-    if index > 0:
-        prev = not_confimed_reservations[index - 1]
+    if position > 0:
+        prev = window[position - 1]
         nav_buttons.append(
             InlineKeyboardButton("⬅️", callback_data=f"reservation:{prev['id']}:{index-1}")
         )
@@ -167,8 +195,8 @@ async def view_reservation(update: Update, context: ContextTypes.DEFAULT_TYPE, r
         InlineKeyboardButton("📋 К списку", callback_data="view_reservations")
     )
 
-    if index < total - 1:
-        next_ = not_confimed_reservations[index + 1]
+    if position + 1 < len(window):
+        next_ = window[position + 1]
         nav_buttons.append(
             InlineKeyboardButton("➡️", callback_data=f"reservation:{next_['id']}:{index+1}")
         )
@@ -192,10 +220,12 @@ def format_phone(phone: str) -> str:
         digits = "7" + digits[1:]
     return "+" + digits
 
+def make_external_number(reservation_id: str) -> str:
+    # номер - полный id заявки: по нему сверяем бронь, найденную при повторе задания
+    return f"RES-{reservation_id}"
+
 async def create_reserve(reservation_data: dict):
-    token = update_iiko_token(os.getenv("IIKO_KEY"))
-    reserve_id = str(uuid.uuid4())
-    external_number = f"RES-{reserve_id[:8]}"
+    external_number = make_external_number(reservation_data["id"])
 
     dt = datetime.fromisoformat(f"{reservation_data['date']}T{reservation_data['time']}")
     iso_date = dt.isoformat()
@@ -203,6 +233,8 @@ async def create_reserve(reservation_data: dict):
     body = {
         "organizationId": os.getenv("ORGANIZATION_ID"),
         "terminalGroupId": os.getenv("TERMINAL_GROUP_ID"),
+        # id брони в iiko задаём сами - тот же, что у заявки, чтобы после потерянного ответа её можно было найти
+        "id": reservation_data["id"],
         "externalNumber": external_number,
         "customer": {
             "name": reservation_data["name"],
@@ -218,58 +250,57 @@ async def create_reserve(reservation_data: dict):
         "eventType": reservation_data.get("eventType", "telegram_bot")
     }
 
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {token}" 
-    }
-
-    async with httpx.AsyncClient(timeout=15) as client:
-        r = await client.post(os.getenv("IIKO_CREATE_URL"), headers=headers, json=body)
+    r = await iiko_client.post("create", body)
 
     if r.status_code != 200:
         return {
     "status": "error",
-    "error": r.text
+    "error": r.text,
+    "status_code": r.status_code
 }
 
 
-    return {"status": "created", "reserve_id": reserve_id, "iiko": r.json()}   
+    return {"status": "created", "external_number": external_number, "iiko": r.json()}   
+
+async def find_reserve(reservation_id: str) -> dict | None:
+    # бронь, которую создала прошлая попытка задания; None - iiko её не принял
+    body = {"organizationId": os.getenv("ORGANIZATION_ID"), "reserveIds": [reservation_id]}
+    r = await iiko_client.post("reserve_status", body)
+    r.raise_for_status()
+    for reserve in r.json().get("reserves", []):
+        if (
+            reserve.get("id") == reservation_id
+            and reserve.get("externalNumber") == make_external_number(reservation_id)
+            and reserve.get("creationStatus") != "Error"
+        ):
+            return reserve
+    return None
 
 async def cancel_reservation(reservation_id: str):
-    iiko_id = await get_iikoId_by_id(reservation_id)
+    reservation = await get_reservation_by_id(reservation_id)
+    iiko_id = reservation.get("id_iiko") if reservation else None
     if not iiko_id:
         raise ValueError("iiko reserveId not found for this reservation")
 
-    token = update_iiko_token(os.getenv("IIKO_KEY"))
-
     body = {
         "organizationId": os.getenv("ORGANIZATION_ID"),
         "reserveId": iiko_id,
         "cancelReason": "ClientRefused"
     }
 
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json"
-    }
-
-    async with httpx.AsyncClient(timeout=15) as client:
-        resp = await client.post(
-            os.getenv("IIKO_CANCEL_URL"),
-            json=body,
-            headers=headers
-        )
-        if resp.status_code == 400:
-            return {
-                "success": False,
-                "reason": resp.text
-            }
-
-        resp.raise_for_status()
+    resp = await iiko_client.post("cancel", body)
+    if resp.status_code == 400:
         return {
-            "success": True,
-            "data": resp.json()
+            "success": False,
+            "reason": resp.text
         }
+
+    resp.raise_for_status()
+    await workload_cache.invalidate(reservation["date"])
+    return {
+        "success": True,
+        "data": resp.json()
+    }
     
 async def handle_reservation_decision(update: Update, context: ContextTypes.DEFAULT_TYPE, reservation_id, approved:bool):
     query = update.callback_query
@@ -280,55 +311,15 @@ async def handle_reservation_decision(update: Update, context: ContextTypes.DEFA
             await query.edit_message_text("❌ Заявка не найдена")
             return
 
-    user_id = reservation["user_id"]
-
+    # решение выполняет воркер заданий и сам заменит это сообщение результатом;
+    # принять и отклонить одну заявку одновременно нельзя - у заданий общий ключ
     if approved:
-        user_text = (
-            "✅ Ваша заявка подтверждена!\n\n"
-            f"📅 {reservation['date']} {reservation['time']}\n"
-            f"🍽 Стол: {reservation['table']}\n"
-            f"👥 Кол-во гостей: {reservation['guests']}\n"
-        )
-
-        reservation_data = {
-        "id":reservation["id"],
-        "name": reservation["name"],
-        "phone": reservation["phone"],
-        "table_id": reservation["tableId"],
-        "table": reservation["table"],
-        "guests":reservation["guests"],
-        "date": reservation["date"],
-        "time": reservation["time"]
-        }
-
-        reservation_result = await create_reserve(reservation_data)
-
-        if reservation_result["status"] != "created":
-            await query.edit_message_text(
-                "❌ Ошибка при создании брони в iiko"
-            )
-            return
-
-        iiko_id = reservation_result["iiko"]["reserveInfo"]["id"]
-        await update_reservation_status(reservation_id, "CONFIRMED", iiko_id)
-        schedule_reservation_reminders(context, reservation)
-
+        await reservation_jobs.submit(query, "approve", reservation_id, "⏳ Создаём бронь в iiko...")
     else:
-        user_text = (
-            "❌ К сожалению, ваша заявка отклонена.\n"
-            f"📅 {reservation['date']} {reservation['time']}\n"
-            f"🍽 Стол: {reservation['table']}\n"
-            f"👥 Кол-во гостей: {reservation['guests']}\n\n" 
-            "Попробуйте выбрать другое время или другой стол."
-        )
-        await delete_reservation_by_id(reservation_id)
-        
-    await context.bot.send_message(chat_id=user_id, text=user_text)
-
-    await admin_pagination_callback(update, context)
+        await reservation_jobs.submit(query, "reject", reservation_id, "⏳ Отклоняем заявку...")
 
 async def notify_admin_to_call(context,reservation):
-    admin_ids = [int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x]
+    admin_ids = get_admin_ids()
 
     text = (
         "📞 Гость не подтвердил бронь!\n\n"
@@ -340,4 +331,4 @@ async def notify_admin_to_call(context,reservation):
     )
 
     for admin_id in admin_ids:
-        await context.bot.send_message(chat_id=admin_id, text=text)
+        await context.bot.send_message(chat_id=admin_id, text=text, rate_limit_args={"priority": PRIORITY_ADMIN})
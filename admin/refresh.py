@@ -0,0 +1,62 @@
+import asyncio
+import os
+
+from telegram.error import BadRequest
+
+from admin.comands import (
+    build_admin_page, get_admin_ids, get_admin_views, markup_digest, set_admin_view_digest, update_admin_list,
+    view_digest
+)
+
+# За это окно все события пачки схлопываются в одно обновление списков у админов
+ADMIN_REFRESH_WINDOW = float(os.getenv("ADMIN_REFRESH_WINDOW", 0.5))
+
+
+class AdminViewRefresher:
+    def __init__(self, application, window: float = ADMIN_REFRESH_WINDOW):
+        self.application = application
+        self.window = window
+        self._dirty = False
+        self._task: asyncio.Task | None = None
+
+    def request(self):
+        self._dirty = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        # события, пришедшие во время обновления, снова поднимают флаг - делаем ещё круг
+        while self._dirty:
+            await asyncio.sleep(self.window)
+            self._dirty = False
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"Не удалось обновить списки заявок: {e}")
+
+    async def refresh(self):
+        # списки открывают воркеры API - читаем их из Redis, а не из своего bot_data
+        views = await get_admin_views(get_admin_ids())
+
+        # одна отрисовка на страницу, а не на каждого админа
+        pages = {}
+        for _, view, _ in views:
+            if view["page"] not in pages:
+                pages[view["page"]] = await build_admin_page(view["page"])
+
+        await asyncio.gather(*(
+            self._push(admin_id, view, shown, pages[view["page"]]) for admin_id, view, shown in views
+        ))
+
+    async def _push(self, admin_id: int, view: dict, shown: str | None, markup):
+        digest = markup_digest(markup)
+        if shown == view_digest(view, digest):
+            return
+
+        try:
+            await update_admin_list(self.application, view, markup)
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                print(f"Не удалось обновить список заявок в чате {view['chat_id']}: {e}")
+                return
+        await set_admin_view_digest(admin_id, view, digest)
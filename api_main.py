@@ -1,11 +1,52 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from typing import List, Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from bot.comands import ReservationBot
-from datetime import datetime, timedelta
+from bot.application import build_application, check_webhook_config, BOT_MODE, WEBHOOK_PATH, WEBHOOK_SECRET
+from telegram import Update
+from redis_config import redis_helpers
+from iiko_token.update_token import token_manager
+from iiko_client.client import iiko_client, IikoUnavailable
+from iiko_client.workload_cache import workload_cache, booking_day
+from iiko_client.layout_cache import layout_cache
+from monitoring.metrics import render_metrics
+from contextlib import asynccontextmanager
+import asyncio
+import hmac
+from datetime import date, datetime, timedelta
+import os
 
-app = FastAPI(title="Reservation API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await iiko_client.start()
+    token_manager.start()
+    background = [asyncio.create_task(workload_cache.listen_invalidations())]
+
+    # В режиме webhook каждый воркер uvicorn обрабатывает свою часть обновлений.
+    # Фоновые задачи (напоминания, события заявок) сюда не поднимаем - они только в main.py
+    telegram_app = None
+    if BOT_MODE == "webhook":
+        telegram_app, _ = build_application(updater=False)
+        await telegram_app.initialize()
+        await telegram_app.start()
+        # анкеты пользователей кешируются в каждом воркере - держим их согласованными
+        background.append(asyncio.create_task(redis_helpers.listen_user_data_invalidations()))
+    app.state.telegram_app = telegram_app
+
+    yield
+
+    if telegram_app is not None:
+        await telegram_app.stop()
+        await telegram_app.shutdown()
+    for task in background:
+        task.cancel()
+    await token_manager.close()
+    await iiko_client.close()
+
+app = FastAPI(title="Reservation API", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -17,9 +58,26 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(GZipMiddleware, minimum_size=500)
+
+@app.exception_handler(IikoUnavailable)
+async def iiko_unavailable_handler(request: Request, exc: IikoUnavailable):
+    # iiko лежит и отдать нечего - быстрый 503 вместо зависшего запроса
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Сервис бронирования временно недоступен"},
+        headers={"Retry-After": "30"}
+    )
 
 bot = ReservationBot(app)
 
+WORK_DAY_START = os.getenv("WORK_DAY_START", "10:00")
+WORK_DAY_END = os.getenv("WORK_DAY_END", "23:00")
+SLOT_MINUTES = int(os.getenv("SLOT_MINUTES", 30))
+GRID_MAX_DAYS = int(os.getenv("GRID_MAX_DAYS", 14))
+# больше слотов за раз WebApp не спрашивает: рабочий день с шагом в 15 минут
+BATCH_MAX_TIMES = int(os.getenv("BATCH_MAX_TIMES", 64))
+
 class ReservationTableRequest(BaseModel):
     date: str
     time: str
@@ -27,26 +85,148 @@ class ReservationTableRequest(BaseModel):
 class ReservationTableResponse(BaseModel):
     tableNumber: Optional[int] = None
 
+class ReservationTablesBatchRequest(BaseModel):
+    date: str
+    times: List[str] = Field(max_length=BATCH_MAX_TIMES)
+    tableId: Optional[str] = None
+    duration: int = 120
+
+class ReservationGridRequest(BaseModel):
+    date: str
+    dateTo: Optional[str] = None
+    tableIds: Optional[List[str]] = None
+    slotMinutes: int = SLOT_MINUTES
+
+def request_day(value: str) -> str:
+    # дата идёт ключом в кеши загрузки - принимаем только дни окна бронирования
+    try:
+        return booking_day(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Некорректная дата или дата вне окна бронирования")
+
+def request_time(day: str, value: str) -> datetime:
+    try:
+        return datetime.fromisoformat(f"{day}T{value}")
+    except ValueError:
+        raise HTTPException(status_code=422, detail=f"Некорректное время: {value}")
+
+def day_slots(slot_minutes: int) -> list[str]:
+    start = datetime.strptime(WORK_DAY_START, "%H:%M")
+    end = datetime.strptime(WORK_DAY_END, "%H:%M")
+
+    slots = []
+    while start < end:
+        slots.append(start.strftime("%H:%M"))
+        start += timedelta(minutes=slot_minutes)
+    return slots
+
 @app.post("/api/reservations/table")
 async def get_reserved_tables(req: ReservationTableRequest):
-    day_reservations = await bot.fetch_day_reservations(req.date)
+    day = request_day(req.date)
+    requested_time = request_time(day, req.time)
+    occupancy, stale = await bot.day_occupancy(day)
 
-    requested_time = datetime.fromisoformat(
-        f"{req.date}T{req.time}"
-    )
+    return {
+        "reservedTableIds": list(occupancy.busy_at(requested_time)),
+        "stale": stale
+    }
+
+@app.post("/api/reservations/tables")
+async def get_reserved_tables_batch(req: ReservationTablesBatchRequest):
+    day = request_day(req.date)
+    requested_times = {time: request_time(day, time) for time in req.times}
+    occupancy, stale = await bot.day_occupancy(day)
+
+    slots = {}
+    for time, requested_time in requested_times.items():
+        slot = {"reservedTableIds": list(occupancy.busy_at(requested_time))}
+        if req.tableId:
+            slot["tableFree"] = occupancy.is_free(req.tableId, requested_time, req.duration)
+        slots[time] = slot
+
+    return {
+        "date": day,
+        "slots": slots,
+        "stale": stale
+    }
+
+@app.post("/api/reservations/grid")
+async def get_reservations_grid(req: ReservationGridRequest):
+    date_from = date.fromisoformat(request_day(req.date))
+    date_to = date.fromisoformat(request_day(req.dateTo)) if req.dateTo else date_from
+    days_count = min((date_to - date_from).days + 1, GRID_MAX_DAYS)
+    days = [(date_from + timedelta(days=i)).isoformat() for i in range(max(days_count, 1))]
 
-    reserved_table_ids: set[str] = set()
-    if len(day_reservations) != 0:
-        for r in day_reservations:
-            print(r)
-            start = datetime.fromisoformat(r["estimatedStartTime"])
-            duration = r.get("durationInMinutes", 120) 
-            end = start + timedelta(minutes=duration)
+    slots = day_slots(max(req.slotMinutes, 5))
+    results = await asyncio.gather(*(bot.day_occupancy(day) for day in days))
+    occupancies = [occupancy for occupancy, _ in results]
 
-            if start <= requested_time < end:
-                reserved_table_ids.update(r.get("tableIds", []))
-            print(reserved_table_ids)
+    table_ids = req.tableIds
+    if not table_ids:
+        # все столы зала, а не только те, у которых есть брони: свободные тоже нужны в сетке
+        layout = await bot.fetch_layout(os.getenv("TERMINAL_GROUP_ID"))
+        table_ids = [
+            table["id"]
+            for section in layout["sections"] if not section.get("isDeleted")
+            for table in section["tables"]
+        ]
+
+    # по каждому столу строка из 0/1: i-й символ - занят ли стол в i-й слот
+    grid = {}
+    for day, occupancy in zip(days, occupancies):
+        busy = occupancy.busy_at_many([datetime.fromisoformat(f"{day}T{slot}") for slot in slots])
+        grid[day] = [
+            "".join("1" if table_id in slot_busy else "0" for slot_busy in busy)
+            for table_id in table_ids
+        ]
 
     return {
-        "reservedTableIds": list(reserved_table_ids)
+        "slots": slots,
+        "tableIds": table_ids,
+        "days": grid,
+        "staleDays": [day for day, (_, stale) in zip(days, results) if stale]
     }
+
+def layout_response(request: Request, version: str, body: str, cache_control: str) -> Response:
+    etag = f'"{version}"'
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+@app.get("/api/layout")
+async def get_current_layout(request: Request):
+    layout = await bot.fetch_layout(os.getenv("TERMINAL_GROUP_ID"))
+    body = await layout_cache.read_version(layout["version"])
+    response = layout_response(request, layout["version"], body, "no-cache")
+    if layout.get("stale"):
+        response.headers["X-Layout-Stale"] = "1"
+    return response
+
+@app.get("/api/layout/{version}")
+async def get_layout(version: str, request: Request):
+    body = await layout_cache.read_version(version)
+    if body is None:
+        raise HTTPException(status_code=404, detail="Layout version not found")
+    # версия - хеш содержимого, поэтому ответ можно кешировать навсегда
+    return layout_response(request, version, body, "public, max-age=31536000, immutable")
+
+@app.get("/metrics")
+async def metrics():
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+async def telegram_webhook(request: Request):
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+        raise HTTPException(status_code=403)
+
+    telegram_app = request.app.state.telegram_app
+    update = Update.de_json(await request.json(), telegram_app.bot)
+    # отвечаем Telegram сразу, обработка идёт в очереди приложения
+    await telegram_app.update_queue.put(update)
+    return Response(status_code=200)
+
+if BOT_MODE == "webhook":
+    check_webhook_config(require_url=False)
+    app.add_api_route(f"/{WEBHOOK_PATH}", telegram_webhook, methods=["POST"], include_in_schema=False)
@@ -0,0 +1,216 @@
+# Заглушка iiko Cloud API для нагрузочных прогонов: те же пути и форма ответов,
+# что использует бот, с настраиваемой задержкой, долей ошибок и объёмом данных.
+#
+#   python -m bench.fake_iiko --port 8701 --latency-ms 80 --error-rate 0.01 --tables 40
+import argparse
+import asyncio
+import random
+import uuid
+from datetime import datetime, timedelta
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+TOKEN_PATH = "/api/1/access_token"
+TABLES_PATH = "/api/1/reserve/available_restaurant_sections"
+WORKLOAD_PATH = "/api/1/reserve/restaurant_sections_workload"
+CREATE_PATH = "/api/1/reserve/create"
+CANCEL_PATH = "/api/1/reserve/cancel"
+RESERVE_STATUS_PATH = "/api/1/reserve/status_by_id"
+
+
+def endpoint_urls(base_url: str) -> dict:
+    # переменные окружения iiko_client для работы против заглушки
+    base_url = base_url.rstrip("/")
+    return {
+        "IIKO_TOKEN_URL": base_url + TOKEN_PATH,
+        "IIKO_API_URL": base_url + TABLES_PATH,
+        "IIKO_WORKLOAD_URL": base_url + WORKLOAD_PATH,
+        "IIKO_CREATE_URL": base_url + CREATE_PATH,
+        "IIKO_CANCEL_URL": base_url + CANCEL_PATH,
+        "IIKO_RESERVE_STATUS_URL": base_url + RESERVE_STATUS_PATH,
+    }
+
+
+def table_id(number: int) -> str:
+    return str(uuid.UUID(int=number))
+
+
+def build_section(section_id: str, tables: int) -> dict:
+    return {
+        "id": section_id,
+        "name": "Основной зал",
+        "tables": [
+            {
+                "id": table_id(n),
+                "number": n,
+                "name": f"Стол {n}",
+                "seatingCapacity": 2 + n % 5,
+                "isDeleted": False
+            }
+            for n in range(1, tables + 1)
+        ],
+        "schema": {
+            "tableElements": [
+                {"tableId": table_id(n), "x": (n % 10) * 60, "y": (n // 10) * 60, "width": 50, "height": 50}
+                for n in range(1, tables + 1)
+            ]
+        },
+        "isDeleted": False
+    }
+
+
+def generate_reserves(date: str, tables: int, per_day: int) -> list[dict]:
+    # одна и та же дата всегда даёт одинаковую загрузку - прогоны сравнимы между собой
+    rnd = random.Random(date)
+    day = datetime.fromisoformat(f"{date}T10:00:00")
+    reserves = []
+    for i in range(per_day):
+        start = day + timedelta(minutes=30 * rnd.randrange(0, 24))
+        reserves.append({
+            "id": str(uuid.UUID(int=rnd.getrandbits(128))),
+            "tableIds": [table_id(rnd.randint(1, tables))],
+            "estimatedStartTime": start.strftime("%Y-%m-%d %H:%M:%S.000"),
+            "durationInMinutes": rnd.choice([60, 90, 120, 180])
+        })
+    return reserves
+
+
+def create_app(
+    latency_ms: float = 50,
+    jitter_ms: float = 20,
+    error_rate: float = 0.0,
+    tables: int = 30,
+    reserves_per_day: int = 40,
+    section_id: str = "00000000-0000-0000-0000-00000000f00d"
+) -> FastAPI:
+    app = FastAPI(title="Fake iiko")
+    section = build_section(section_id, tables)
+    # reserveId -> (date, reserve) для созданных через /reserve/create
+    created: dict[str, tuple[str, dict]] = {}
+    # externalNumber -> reserveId: повторный create с тем же номером отдаёт ту же бронь
+    external_numbers: dict[str, str] = {}
+    stats: dict[str, int] = {}
+
+    async def simulate(name: str):
+        stats[name] = stats.get(name, 0) + 1
+        await asyncio.sleep(max(0.0, latency_ms + random.uniform(-jitter_ms, jitter_ms)) / 1000)
+        if error_rate and random.random() < error_rate:
+            return JSONResponse({"errorDescription": "fake iiko error"}, status_code=500)
+        return None
+
+    @app.post(TOKEN_PATH)
+    async def access_token(request: Request):
+        if error := await simulate("token"):
+            return error
+        return {"correlationId": str(uuid.uuid4()), "token": str(uuid.uuid4())}
+
+    @app.post(TABLES_PATH)
+    async def restaurant_sections(request: Request):
+        if error := await simulate("tables"):
+            return error
+        body = await request.json()
+        # на запрос с актуальной ревизией iiko отдаёт пустой список изменений
+        if body.get("revision", 0) >= 1:
+            return {"revision": 1, "restaurantSections": []}
+        return {"revision": 1, "restaurantSections": [section]}
+
+    @app.post(WORKLOAD_PATH)
+    async def workload(request: Request):
+        if error := await simulate("workload"):
+            return error
+        body = await request.json()
+        # бот спрашивает один день, синхронизация - окно из нескольких
+        day = datetime.fromisoformat(body["dateFrom"][:10])
+        last = datetime.fromisoformat(body["dateTo"][:10])
+        reserves = []
+        while day <= last:
+            date = day.date().isoformat()
+            reserves.extend(generate_reserves(date, tables, reserves_per_day))
+            reserves.extend(reserve for created_day, reserve in created.values() if created_day == date)
+            day += timedelta(days=1)
+        return {"reserves": reserves}
+
+    @app.post(CREATE_PATH)
+    async def create(request: Request):
+        if error := await simulate("create"):
+            return error
+        body = await request.json()
+        external_number = body.get("externalNumber")
+        reserve_id = external_numbers.get(external_number)
+        if reserve_id is None or reserve_id not in created:
+            reserve_id = body.get("id") or str(uuid.uuid4())
+            start = body["estimatedStartTime"]
+            created[reserve_id] = (start[:10], {
+                "id": reserve_id,
+                "externalNumber": external_number,
+                "tableIds": body.get("tableIds", []),
+                "estimatedStartTime": start,
+                "durationInMinutes": body.get("durationInMinutes", 120)
+            })
+            if external_number:
+                external_numbers[external_number] = reserve_id
+        # бронь создана, а ответ потерялся - бот должен найти её, а не создать вторую
+        if error_rate and random.random() < error_rate:
+            stats["create_lost"] = stats.get("create_lost", 0) + 1
+            return JSONResponse({"errorDescription": "fake iiko timeout"}, status_code=504)
+        return {"correlationId": str(uuid.uuid4()), "reserveInfo": {"id": reserve_id}}
+
+    @app.post(RESERVE_STATUS_PATH)
+    async def reserve_status(request: Request):
+        if error := await simulate("reserve_status"):
+            return error
+        body = await request.json()
+        reserves = [
+            {
+                "id": reserve_id,
+                "externalNumber": created[reserve_id][1].get("externalNumber"),
+                "creationStatus": "Success"
+            }
+            for reserve_id in body.get("reserveIds", [])
+            if reserve_id in created
+        ]
+        return {"correlationId": str(uuid.uuid4()), "reserves": reserves}
+
+    @app.post(CANCEL_PATH)
+    async def cancel(request: Request):
+        if error := await simulate("cancel"):
+            return error
+        body = await request.json()
+        if created.pop(body.get("reserveId"), None) is None:
+            return JSONResponse({"errorDescription": "reserve not found"}, status_code=400)
+        return {"correlationId": str(uuid.uuid4())}
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake iiko Cloud API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8701)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--tables", type=int, default=30)
+    parser.add_argument("--reserves-per-day", type=int, default=40)
+    parser.add_argument("--section-id", default="00000000-0000-0000-0000-00000000f00d")
+    args = parser.parse_args()
+
+    app = create_app(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        tables=args.tables,
+        reserves_per_day=args.reserves_per_day,
+        section_id=args.section_id
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
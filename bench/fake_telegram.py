@@ -0,0 +1,106 @@
+# Заглушка Telegram Bot API: принимает вызовы бота и отвечает правдоподобными объектами,
+# ничего никуда не отправляя. Бот направляется сюда через TELEGRAM_BASE_URL.
+#
+#   python -m bench.fake_telegram --port 8702 --latency-ms 30
+#   TELEGRAM_BASE_URL=http://127.0.0.1:8702/bot python main.py
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+import urllib.parse
+
+import uvicorn
+from fastapi import FastAPI, Request
+
+BOT_USER = {
+    "id": 100000001,
+    "is_bot": True,
+    "first_name": "Bench",
+    "username": "bench_bot",
+    "can_join_groups": False,
+    "can_read_all_group_messages": False,
+    "supports_inline_queries": False
+}
+
+
+async def read_params(request: Request) -> dict:
+    # PTB шлёт параметры формой, сложные значения - JSON-строками
+    raw = await request.body()
+    if request.headers.get("content-type", "").startswith("application/json"):
+        return json.loads(raw or b"{}")
+
+    params = {}
+    for key, value in urllib.parse.parse_qsl(raw.decode(), keep_blank_values=True):
+        try:
+            params[key] = json.loads(value)
+        except ValueError:
+            params[key] = value
+    return params
+
+
+class BotApiStub:
+    # Ответы Bot API без сети; общий для HTTP-заглушки и офлайн-бота в bench/replay.py
+    def __init__(self):
+        self._message_ids = itertools.count(1000)
+        self.stats: dict[str, int] = {}
+
+    def message(self, params: dict, message_id: int | None = None) -> dict:
+        chat_id = int(params.get("chat_id", 0))
+        return {
+            "message_id": message_id or next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+            "from": BOT_USER,
+            "text": str(params.get("text", ""))
+        }
+
+    def answer(self, method: str, params: dict):
+        method = method.lower()
+        self.stats[method] = self.stats.get(method, 0) + 1
+
+        if method == "getme":
+            return BOT_USER
+        if method in ("sendmessage", "sendphoto", "senddocument"):
+            return self.message(params)
+        if method in ("editmessagetext", "editmessagereplymarkup"):
+            return self.message(params, params.get("message_id"))
+        if method == "getwebhookinfo":
+            return {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        if method == "getupdates":
+            return []
+        # deleteMessage(s), answerCallbackQuery, setWebhook и прочее, что отвечает true
+        return True
+
+
+def create_app(latency_ms: float = 30, jitter_ms: float = 10) -> FastAPI:
+    app = FastAPI(title="Fake Telegram Bot API")
+    stub = BotApiStub()
+
+    @app.api_route("/bot{token}/{method}", methods=["GET", "POST"])
+    async def call(token: str, method: str, request: Request):
+        params = await read_params(request)
+        await asyncio.sleep(max(0.0, latency_ms + random.uniform(-jitter_ms, jitter_ms)) / 1000)
+        return {"ok": True, "result": stub.answer(method, params)}
+
+    @app.get("/stats")
+    async def get_stats():
+        return stub.stats
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8702)
+    parser.add_argument("--latency-ms", type=float, default=30)
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    args = parser.parse_args()
+
+    uvicorn.run(create_app(args.latency_ms, args.jitter_ms), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
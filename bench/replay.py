@@ -0,0 +1,294 @@
+# Прогон потока Update через обработчики бота без сети: Bot API отвечает BotApiStub,
+# iiko - заглушка внутри процесса, Redis - локальный (по умолчанию база 15, очищается).
+# Считает CPU, команды Redis и аллокации на обработчик.
+#
+#   python -m bench.replay --generate 5000 --save updates.jsonl
+#   python -m bench.replay --input updates.jsonl --tracemalloc --output replay_results.json
+#   python -m bench.replay --input updates.jsonl --concurrency 64
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+from telegram.request import BaseRequest
+
+from bench.fake_telegram import BotApiStub
+
+FAKE_IIKO_URL = "http://fake-iiko"
+
+
+class OfflineRequest(BaseRequest):
+    def __init__(self, stub: BotApiStub):
+        self.stub = stub
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        params = request_data.parameters if request_data else {}
+        result = self.stub.answer(url.rsplit("/", 1)[-1], params)
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def handler_label(raw: dict) -> str:
+    from monitoring.metrics import callback_action
+
+    if "callback_query" in raw:
+        return "callback:" + callback_action(raw["callback_query"].get("data"))
+    message = raw.get("message") or {}
+    if "web_app_data" in message:
+        return "web_app"
+    if "contact" in message:
+        return "contact"
+    if str(message.get("text", "")).startswith("/"):
+        return "start"
+    if "text" in message:
+        return "text"
+    return "other"
+
+
+def redis_command_count() -> float:
+    # пайплайн - одна команда: считаем обращения к Redis, а не операции внутри них
+    from monitoring.metrics import REDIS_LATENCY
+
+    return sum(
+        sample.value
+        for metric in REDIS_LATENCY.collect()
+        for sample in metric.samples
+        if sample.name.endswith("_count")
+    )
+
+
+async def generate_updates(count: int, tables: list[dict], days: int, seed: int = 7) -> list[dict]:
+    from admin.comands import ADMIN_PAGE_SIZE
+    from bench import updates
+    from bench.run import ADMIN_ID, random_slot
+    from redis_config.redis_helpers import count_reservations_by_status, get_reservations_by_status
+
+    rnd = random.Random(seed)
+    total = await count_reservations_by_status("PENDING")
+    pending = await get_reservations_by_status("PENDING", 0, min(total, 500) - 1) if total else []
+    pages = max((total + ADMIN_PAGE_SIZE - 1) // ADMIN_PAGE_SIZE, 1)
+
+    stream = []
+    user_id = 600_000
+    while len(stream) < count:
+        kind = rnd.random()
+        if kind < 0.5:
+            user_id += 1
+            table = rnd.choice(tables)
+            day, slot = random_slot(rnd, days)
+            stream.extend(raw for _, raw in updates.booking_flow(user_id, table["id"], table["number"], day, slot))
+        elif kind < 0.7:
+            stream.append(updates.callback(ADMIN_ID, f"page:{rnd.randrange(pages)}"))
+        elif kind < 0.85 and pending:
+            rank = rnd.randrange(len(pending))
+            stream.append(updates.callback(ADMIN_ID, f"reservation:{pending[rank]['id']}:{rank}"))
+        elif kind < 0.95 and pending:
+            reservation = rnd.choice(pending)
+            stream.append(updates.callback(reservation["user_id"], f"confirm_yes:{reservation['id']}"))
+        else:
+            stream.append(updates.command(rnd.randint(700_000, 700_100)))
+    return stream[:count]
+
+
+def load_updates(path: str) -> list[dict]:
+    # по Update на строку; ответ getUpdates целиком тоже подходит
+    with open(path, encoding="utf-8") as f:
+        raws = [json.loads(line) for line in f if line.strip()]
+    if len(raws) == 1 and isinstance(raws[0], dict) and "result" in raws[0]:
+        return raws[0]["result"]
+    return raws
+
+
+def summarize_handler(records: list[dict]) -> dict:
+    from bench.run import percentile
+
+    cpu = sorted(r["cpu"] for r in records)
+    wall = sorted(r["wall"] for r in records)
+    result = {
+        "count": len(records),
+        "cpu_ms_mean": round(sum(cpu) / len(cpu) * 1000, 3),
+        "cpu_ms_p99": round(percentile(cpu, 0.99) * 1000, 3),
+        "wall_ms_p50": round(percentile(wall, 0.50) * 1000, 3),
+        "wall_ms_p99": round(percentile(wall, 0.99) * 1000, 3),
+        "redis_ops_mean": round(sum(r["redis"] for r in records) / len(records), 2),
+    }
+    if "alloc" in records[0]:
+        result["alloc_peak_kb_mean"] = round(sum(r["alloc"] for r in records) / len(records) / 1024, 2)
+    return result
+
+
+async def replay_sequential(application, raws: list[dict], trace: bool) -> dict:
+    # по одному обновлению - так CPU, Redis и аллокации честно относятся к своему обработчику
+    from telegram import Update
+
+    handlers: dict[str, list[dict]] = {}
+    for raw in raws:
+        update = Update.de_json(raw, application.bot)
+        redis_before = redis_command_count()
+        if trace:
+            tracemalloc.reset_peak()
+            memory_before = tracemalloc.get_traced_memory()[0]
+        cpu_before = time.process_time()
+        wall_before = time.perf_counter()
+
+        await application.process_update(update)
+
+        record = {
+            "wall": time.perf_counter() - wall_before,
+            "cpu": time.process_time() - cpu_before,
+            "redis": redis_command_count() - redis_before,
+        }
+        if trace:
+            record["alloc"] = tracemalloc.get_traced_memory()[1] - memory_before
+        handlers.setdefault(handler_label(raw), []).append(record)
+
+    return {label: summarize_handler(records) for label, records in sorted(handlers.items())}
+
+
+async def replay_concurrent(application, raws: list[dict], concurrency: int):
+    # как в проде: через PerUserUpdateProcessor, с упорядочиванием по пользователю
+    from telegram import Update
+
+    queue: asyncio.Queue = asyncio.Queue()
+    for raw in raws:
+        queue.put_nowait(Update.de_json(raw, application.bot))
+
+    processor = application.update_processor
+
+    async def worker():
+        while not queue.empty():
+            update = queue.get_nowait()
+            await processor.process_update(update, application.process_update(update))
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+async def run_replay(args) -> dict:
+    import httpx
+    from bench.fake_iiko import create_app
+    from bench.run import seed_reservations
+    from bot.application import build_application
+    from iiko_client.client import iiko_client
+    from redis_config import redis_client as redis
+
+    await redis.redis_client.flushdb()
+    iiko_client._client = httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=create_app(latency_ms=args.iiko_latency_ms, jitter_ms=0)),
+        headers={"Content-Type": "application/json"}
+    )
+    await seed_reservations(args.reservations, args.days)
+
+    stub = BotApiStub()
+    application, bot = build_application(updater=False, request=OfflineRequest(stub))
+    await application.initialize()
+    try:
+        layout = await bot.fetch_layout(os.environ["TERMINAL_GROUP_ID"])
+        tables = [t for section in layout["sections"] for t in section["tables"]]
+
+        if args.input:
+            raws = load_updates(args.input)
+        else:
+            raws = await generate_updates(args.generate, tables, args.days)
+        if args.save:
+            with open(args.save, "w", encoding="utf-8") as f:
+                f.writelines(json.dumps(raw, ensure_ascii=False) + "\n" for raw in raws)
+
+        if args.tracemalloc:
+            tracemalloc.start(args.tracemalloc_frames)
+            snapshot_before = tracemalloc.take_snapshot()
+
+        redis_before = redis_command_count()
+        cpu_before = time.process_time()
+        started = time.perf_counter()
+        handlers = None
+        if args.concurrency > 1:
+            await replay_concurrent(application, raws, args.concurrency)
+        else:
+            handlers = await replay_sequential(application, raws, args.tracemalloc)
+        await bot.message_cleaner.drain()
+        wall = time.perf_counter() - started
+        cpu = time.process_time() - cpu_before
+        redis_ops = redis_command_count() - redis_before
+
+        result = {
+            "totals": {
+                "updates": len(raws),
+                "wall_s": round(wall, 3),
+                "updates_per_s": round(len(raws) / wall, 1) if wall else 0.0,
+                "cpu_ms_per_update": round(cpu / len(raws) * 1000, 3) if raws else 0.0,
+                "redis_ops_per_update": round(redis_ops / len(raws), 2) if raws else 0.0,
+                "bot_api_calls": dict(sorted(stub.stats.items())),
+            }
+        }
+        if handlers is not None:
+            result["handlers"] = handlers
+        if args.tracemalloc:
+            stats = tracemalloc.take_snapshot().compare_to(snapshot_before, "lineno")
+            tracemalloc.stop()
+            result["top_allocations"] = [
+                {"site": str(stat.traceback[0]), "size_kb": round(stat.size_diff / 1024, 1), "count": stat.count_diff}
+                for stat in stats[:args.top]
+            ]
+        return result
+    finally:
+        await application.shutdown()
+        await iiko_client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Прогон Update через обработчики бота без сети")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--input", help="JSONL с Update (по одному на строку)")
+    source.add_argument("--generate", type=int, default=2000, help="сгенерировать столько Update")
+    parser.add_argument("--save", help="сохранить поток Update в JSONL для повторных прогонов")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="1 - по одному с разбивкой по обработчикам, больше - только пропускная способность")
+    parser.add_argument("--reservations", type=int, default=2000, help="заявок в очереди администратора")
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--iiko-latency-ms", type=float, default=0)
+    parser.add_argument("--tracemalloc", action="store_true", help="считать аллокации (заметно медленнее)")
+    parser.add_argument("--tracemalloc-frames", type=int, default=1)
+    parser.add_argument("--top", type=int, default=15, help="сколько мест аллокаций показать")
+    parser.add_argument("--redis-db", type=int, default=int(os.getenv("BENCH_REDIS_DB", 15)))
+    parser.add_argument("--output", default="replay_results.json")
+    args = parser.parse_args()
+
+    if args.redis_db == 0:
+        parser.error("база 0 - рабочая, прогон её очистит; укажите --redis-db")
+
+    from bench.run import bench_env, git_revision
+
+    os.environ.update(bench_env(FAKE_IIKO_URL, args.redis_db))
+    result = asyncio.run(run_replay(args))
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "git": git_revision(),
+            "python": sys.version.split()[0],
+            "config": {k: v for k, v in vars(args).items() if k != "output"},
+        },
+        **result,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(json.dumps(result["totals"], ensure_ascii=False))
+    print(f"Результаты записаны в {args.output}")
+
+
+if __name__ == "__main__":
+    main()
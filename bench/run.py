@@ -0,0 +1,338 @@
+# Нагрузочные сценарии против локальных заглушек iiko и Telegram и локального Redis.
+# Redis очищается перед прогоном, поэтому по умолчанию берётся отдельная база REDIS_DB=15.
+#
+#   python -m bench.run --scenarios table,booking,admin --output bench_results.json
+#   python -m bench.run --compare bench_results.json --output bench_new.json
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from datetime import date, timedelta
+
+SCENARIOS = ("table", "booking", "admin")
+ADMIN_ID = 42
+
+
+def bench_env(iiko_url: str, redis_db: int) -> dict:
+    # конфигурация читается модулями при импорте, поэтому выставляется до импорта бота и API
+    from bench.fake_iiko import endpoint_urls
+
+    env = endpoint_urls(iiko_url)
+    env.update({
+        "TOKEN": "123456:bench",
+        "ADMIN_IDS": str(ADMIN_ID),
+        "SECTION_ID": "00000000-0000-0000-0000-00000000f00d",
+        "TERMINAL_GROUP_ID": "bench-terminal-group",
+        "ORGANIZATION_ID": "bench-organization",
+        "IIKO_KEY": "bench",
+        "WEB_APP_URL": "https://example.invalid/webapp",
+        "REDIS_DB": str(redis_db),
+        "METRICS_PORT": "0",
+    })
+    # лимиты Telegram меряли бы лимитер, а не наш код; для замера лимитера - переопределить
+    for key, value in (("TG_GLOBAL_RATE", "100000"), ("TG_CHAT_RATE", "100000"), ("TG_CHAT_BURST", "100000")):
+        env[key] = os.getenv(key, value)
+    return env
+
+
+def configure_env(args):
+    os.environ.update(bench_env(f"http://127.0.0.1:{args.iiko_port}", args.redis_db))
+    os.environ["TELEGRAM_BASE_URL"] = f"http://127.0.0.1:{args.telegram_port}/bot"
+
+
+def start_fakes(args) -> list[subprocess.Popen]:
+    processes = [
+        subprocess.Popen([
+            sys.executable, "-m", "bench.fake_iiko",
+            "--port", str(args.iiko_port),
+            "--latency-ms", str(args.iiko_latency_ms),
+            "--error-rate", str(args.iiko_error_rate),
+            "--tables", str(args.tables),
+            "--reserves-per-day", str(args.reserves_per_day),
+            "--section-id", os.environ["SECTION_ID"],
+        ]),
+        subprocess.Popen([
+            sys.executable, "-m", "bench.fake_telegram",
+            "--port", str(args.telegram_port),
+            "--latency-ms", str(args.telegram_latency_ms),
+        ]),
+    ]
+    for port in (args.iiko_port, args.telegram_port):
+        wait_for_port(port)
+    return processes
+
+
+def wait_for_port(port: int, timeout: float = 15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Заглушка на порту {port} не поднялась за {timeout} с")
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+def summarize(latencies: list[float], errors: int, wall: float) -> dict:
+    values = sorted(latencies)
+    return {
+        "count": len(values),
+        "errors": errors,
+        "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+        "p90_ms": round(percentile(values, 0.90) * 1000, 3),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+        "max_ms": round(values[-1] * 1000, 3) if values else 0.0,
+        "mean_ms": round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+        "throughput_rps": round(len(values) / wall, 2) if wall else 0.0,
+    }
+
+
+async def run_concurrent(total: int, concurrency: int, operation) -> dict:
+    # concurrency воркеров разбирают номера операций 0..total-1
+    latencies: list[float] = []
+    errors = 0
+    counter = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            start = time.perf_counter()
+            try:
+                await operation(i)
+            except Exception as e:
+                errors += 1
+                if errors <= 5:
+                    print(f"Ошибка в операции {i}: {e!r}")
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+def random_slot(rnd: random.Random, days: int) -> tuple[str, str]:
+    day = date.today() + timedelta(days=rnd.randrange(days))
+    minutes = 10 * 60 + 30 * rnd.randrange(26)
+    return day.isoformat(), f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+async def scenario_table(args) -> dict:
+    import httpx
+    from api_main import app
+
+    rnd = random.Random(1)
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            async def operation(i):
+                day, slot = random_slot(rnd, args.days)
+                response = await client.post("/api/reservations/table", json={"date": day, "time": slot})
+                response.raise_for_status()
+
+            return await run_concurrent(args.requests, args.concurrency, operation)
+
+
+async def with_bot(run):
+    from bot.application import build_application
+
+    application, bot = build_application()
+    await application.initialize()
+    try:
+        return await run(application, bot)
+    finally:
+        await bot.message_cleaner.drain()
+        await application.shutdown()
+
+
+async def scenario_booking(args) -> dict:
+    from telegram import Update
+    from bench import updates
+
+    async def run(application, bot):
+        layout = await bot.fetch_layout(os.environ["TERMINAL_GROUP_ID"])
+        tables = [t for section in layout["sections"] for t in section["tables"]]
+        rnd = random.Random(2)
+        steps: dict[str, list[float]] = {}
+
+        async def operation(i):
+            table = rnd.choice(tables)
+            day, slot = random_slot(rnd, args.days)
+            for step, raw in updates.booking_flow(500_000 + i, table["id"], table["number"], day, slot):
+                start = time.perf_counter()
+                await application.process_update(Update.de_json(raw, application.bot))
+                steps.setdefault(step, []).append(time.perf_counter() - start)
+
+        result = await run_concurrent(args.flows, args.concurrency, operation)
+        result["steps"] = {step: summarize(values, 0, 0) for step, values in steps.items()}
+        for step in result["steps"].values():
+            del step["throughput_rps"], step["errors"]
+        return result
+
+    return await with_bot(run)
+
+
+async def seed_reservations(count: int, days: int):
+    from redis_config.redis_helpers import save_reservation
+
+    rnd = random.Random(3)
+    batch = 500
+    for offset in range(0, count, batch):
+        reservations = []
+        for i in range(offset, min(offset + batch, count)):
+            day, slot = random_slot(rnd, days)
+            reservations.append({
+                "user_id": 1_000_000 + i,
+                "name": f"Гость {i}",
+                "phone": f"+7999{i:07d}",
+                "guests": rnd.randint(1, 8),
+                "table": rnd.randint(1, 30),
+                "tableId": f"table-{rnd.randint(1, 30)}",
+                "date": day,
+                "time": slot
+            })
+        await asyncio.gather(*(save_reservation(r) for r in reservations))
+
+
+async def scenario_admin(args) -> dict:
+    from telegram import Update
+    from admin.comands import ADMIN_PAGE_SIZE
+    from bench import updates
+    from redis_config.redis_helpers import count_reservations_by_status, get_reservations_by_status
+
+    started = time.perf_counter()
+    await seed_reservations(args.admin_reservations, args.days)
+    seed_seconds = time.perf_counter() - started
+
+    total = await count_reservations_by_status("PENDING")
+    pages = max((total + ADMIN_PAGE_SIZE - 1) // ADMIN_PAGE_SIZE, 1)
+    sample_ranks = random.Random(4).sample(range(total), min(total, 200))
+    sample = [
+        (rank, (await get_reservations_by_status("PENDING", rank, rank))[0]["id"])
+        for rank in sample_ranks
+    ]
+
+    async def run(application, bot):
+        rnd = random.Random(5)
+
+        async def operation(i):
+            kind = i % 3
+            if kind == 0:
+                data = "view_reservations"
+            elif kind == 1:
+                data = f"page:{rnd.randrange(pages)}"
+            else:
+                rank, reservation_id = rnd.choice(sample)
+                data = f"reservation:{reservation_id}:{rank}"
+            await application.process_update(Update.de_json(updates.callback(ADMIN_ID, data), application.bot))
+
+        return await run_concurrent(args.requests, args.concurrency, operation)
+
+    result = await with_bot(run)
+    result["reservations"] = total
+    result["seed_seconds"] = round(seed_seconds, 3)
+    return result
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous: dict, current: dict):
+    for name, result in current["scenarios"].items():
+        old = previous.get("scenarios", {}).get(name)
+        if not old:
+            continue
+        parts = []
+        for metric in ("p50_ms", "p99_ms", "throughput_rps"):
+            if old.get(metric):
+                change = (result[metric] - old[metric]) / old[metric] * 100
+                parts.append(f"{metric} {old[metric]} -> {result[metric]} ({change:+.1f}%)")
+        print(f"{name}: " + ", ".join(parts))
+
+
+async def run_scenarios(args) -> dict:
+    from redis_config import redis_client as redis
+
+    await redis.redis_client.flushdb()
+    scenarios = {"table": scenario_table, "booking": scenario_booking, "admin": scenario_admin}
+    results = {}
+    for name in args.scenarios:
+        print(f"Сценарий {name}...")
+        results[name] = await scenarios[name](args)
+        print(json.dumps(results[name], ensure_ascii=False))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочные сценарии бота и API бронирования")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        type=lambda value: [s for s in value.split(",") if s])
+    parser.add_argument("--requests", type=int, default=2000, help="запросов в сценариях table и admin")
+    parser.add_argument("--flows", type=int, default=200, help="полных бронирований в сценарии booking")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--days", type=int, default=7, help="на сколько дней вперёд разбросаны даты")
+    parser.add_argument("--admin-reservations", type=int, default=10_000)
+    parser.add_argument("--tables", type=int, default=30)
+    parser.add_argument("--reserves-per-day", type=int, default=40)
+    parser.add_argument("--iiko-port", type=int, default=8701)
+    parser.add_argument("--iiko-latency-ms", type=float, default=50)
+    parser.add_argument("--iiko-error-rate", type=float, default=0.0)
+    parser.add_argument("--telegram-port", type=int, default=8702)
+    parser.add_argument("--telegram-latency-ms", type=float, default=30)
+    parser.add_argument("--redis-db", type=int, default=int(os.getenv("BENCH_REDIS_DB", 15)))
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+    args = parser.parse_args()
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+    if args.redis_db == 0:
+        parser.error("база 0 - рабочая, прогон её очистит; укажите --redis-db")
+
+    configure_env(args)
+    processes = start_fakes(args)
+    try:
+        results = asyncio.run(run_scenarios(args))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "git": git_revision(),
+            "python": sys.version.split()[0],
+            "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        },
+        "scenarios": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты записаны в {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
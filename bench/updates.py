@@ -0,0 +1,96 @@
+# Сырые Update в формате Bot API для прогонов через обработчики бота
+import itertools
+import json
+import time
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+
+def user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"Гость {user_id}", "language_code": "ru"}
+
+
+def chat(user_id: int) -> dict:
+    return {"id": user_id, "type": "private", "first_name": f"Гость {user_id}"}
+
+
+def _message(user_id: int, **fields) -> dict:
+    return {
+        "message_id": next(_message_ids),
+        "date": int(time.time()),
+        "chat": chat(user_id),
+        "from": user(user_id),
+        **fields
+    }
+
+
+def command(user_id: int, text: str = "/start") -> dict:
+    return {
+        "update_id": next(_update_ids),
+        "message": _message(
+            user_id,
+            text=text,
+            entities=[{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        )
+    }
+
+
+def text(user_id: int, value: str) -> dict:
+    return {"update_id": next(_update_ids), "message": _message(user_id, text=value)}
+
+
+def callback(user_id: int, data: str) -> dict:
+    return {
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_update_ids)),
+            "from": user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": next(_message_ids),
+                "date": int(time.time()),
+                "chat": chat(user_id),
+                "from": {"id": 100000001, "is_bot": True, "first_name": "Bench"},
+                "text": "..."
+            }
+        }
+    }
+
+
+def contact(user_id: int, phone: str) -> dict:
+    return {
+        "update_id": next(_update_ids),
+        "message": _message(user_id, contact={"phone_number": phone, "first_name": f"Гость {user_id}", "user_id": user_id})
+    }
+
+
+def web_app_data(user_id: int, payload: dict) -> dict:
+    return {
+        "update_id": next(_update_ids),
+        "message": _message(user_id, web_app_data={
+            "data": json.dumps(payload, ensure_ascii=False),
+            "button_text": "Выбрать стол"
+        })
+    }
+
+
+def booking_flow(user_id: int, table_id: str, table_number: int, date: str, time_: str) -> list[tuple[str, dict]]:
+    # путь гостя от «Забронировать стол» до заявки администратору
+    return [
+        ("create_reservation", callback(user_id, "create_reservation")),
+        ("me", callback(user_id, "me")),
+        ("edit_phone", callback(user_id, "edit_phone")),
+        ("contact", contact(user_id, f"+7999{user_id % 10_000_000:07d}")),
+        ("edit_table", callback(user_id, "edit_table")),
+        ("web_app_data", web_app_data(user_id, {
+            "action": "create_reservation",
+            "tableId": table_id,
+            "tableNumber": table_number,
+            "guests": 2,
+            "date": date,
+            "time": time_
+        })),
+        ("continue", callback(user_id, "continue")),
+    ]
@@ -0,0 +1,68 @@
+import os
+
+from dotenv import load_dotenv
+from telegram.ext import CommandHandler, MessageHandler, ApplicationBuilder, filters, CallbackQueryHandler
+
+from bot.comands import ReservationBot
+from bot.rate_limiter import PriorityRateLimiter
+from bot.update_processor import PerUserUpdateProcessor
+from monitoring.metrics import timed_handler
+from redis_config.persistence import RedisPersistence
+
+load_dotenv()
+
+TOKEN = os.getenv("TOKEN")
+# локальный Bot API сервер или заглушка из bench/; по умолчанию - api.telegram.org
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL")
+
+# polling - бот сам забирает обновления (main.py);
+# webhook - обновления принимает FastAPI (api_main.py), main.py только регистрирует вебхук
+# и крутит фоновые задачи
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+
+
+def check_webhook_config(require_url: bool = True):
+    # без секрета любой, кто угадал путь, может прислать поддельный Update от имени админа
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("BOT_MODE=webhook требует WEBHOOK_SECRET")
+    if require_url and not WEBHOOK_URL:
+        raise RuntimeError("BOT_MODE=webhook требует WEBHOOK_URL")
+
+
+def build_application(post_init=None, post_shutdown=None, updater: bool = True, request=None):
+    builder = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .rate_limiter(PriorityRateLimiter(distributed=BOT_MODE == "webhook"))
+        .concurrent_updates(PerUserUpdateProcessor(distributed=BOT_MODE == "webhook"))
+        .persistence(RedisPersistence(distributed=BOT_MODE == "webhook"))
+    )
+    if TELEGRAM_BASE_URL:
+        builder = builder.base_url(TELEGRAM_BASE_URL)
+    if request is not None:
+        builder = builder.request(request)
+    if post_init:
+        builder = builder.post_init(post_init)
+    if post_shutdown:
+        builder = builder.post_shutdown(post_shutdown)
+    if not updater:
+        builder = builder.updater(None)
+
+    app = builder.build()
+    bot = ReservationBot(app)
+
+    app.add_handler(CommandHandler("start", timed_handler("start", bot.start)))
+    app.add_handler(CallbackQueryHandler(timed_handler("callback", bot.callback)))
+    app.add_handler(MessageHandler(
+        filters.TEXT & ~filters.COMMAND & ~filters.CONTACT, timed_handler("text", bot.text_handler)
+    ))
+    app.add_handler(MessageHandler(filters.CONTACT, timed_handler("contact", bot.number_handler)))
+    app.add_handler(MessageHandler(
+        filters.StatusUpdate.WEB_APP_DATA, timed_handler("web_app", bot.web_app_handler)
+    ))
+
+    return app, bot
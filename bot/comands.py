@@ -4,110 +4,92 @@ from telegram import (
 )
 from telegram.ext import ContextTypes
 from redis_config import redis_helpers
-from admin.comands import admin_pagination_callback, view_reservation, handle_reservation_decision, update_admin_list, notify_admin_to_call
-import json, requests, urllib.parse
-from redis_config.redis_helpers import get_user_data, set_user_data, get_reservation_by_id, update_reservation_confirmation
-from admin.comands import is_admin, admin_start, get_all_reservations, cancel_reservation
-from iiko_token.update_token import update_iiko_token
+from admin.comands import admin_pagination_callback, view_reservation, handle_reservation_decision, notify_admin_to_call
+import json, urllib.parse
+from redis_config.redis_helpers import get_user_data, set_user_data, get_reservation_by_id, update_reservation_confirmation, get_user_reservations
+from admin.comands import is_admin, admin_start
+from iiko_client.client import iiko_client, is_retryable, IikoUnavailable
+from iiko_client.workload_cache import workload_cache, booking_window, StaleWorkload
+from iiko_client.workload_sync import read_day, fetch_workload
+from iiko_client.layout_cache import layout_cache, normalize_section
+from bot.occupancy import OccupancyIndex
+from bot.reservation_jobs import reservation_jobs
+from admin.refresh import AdminViewRefresher
+from bot.message_cleanup import MessageCleaner
 from dotenv import load_dotenv
 from datetime import date
 
+import httpx
 import os
 
 load_dotenv()
 
 class ReservationBot:
     WEB_APP_URL = os.getenv("WEB_APP_URL")
-    IIKO_API_URL = os.getenv("IIKO_API_URL")
 
     def __init__(self, app):
         self.application = app
+        self.admin_refresher = AdminViewRefresher(app)
+        self.message_cleaner = MessageCleaner(app)
+        # date -> (reserves, индекс); пересобираем только когда кеш отдал новый список
+        self._occupancy: dict[str, tuple[list, OccupancyIndex]] = {}
 
     
-    async def fetch_tables(self, token: str, terminal_group_id: str):
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json"
-        }
+    async def fetch_layout(self, terminal_group_id: str) -> dict:
+        return await layout_cache.get(terminal_group_id, self.load_tables)
 
+    async def load_tables(self, terminal_group_id: str, revision: int):
         payload = {
             "terminalGroupIds": [terminal_group_id],
             "returnSchema": True,
-            "revision": 0
+            "revision": revision
         }
 
-        response = requests.post(self.IIKO_API_URL, json=payload, headers=headers)
+        response = await iiko_client.post("tables", payload)
         response.raise_for_status()
         data = response.json()
-        tables_info = []
-        for section in data.get("restaurantSections", []):
-            section_info = {
-                "id": section["id"],
-                "name": section["name"],
-                "tables": [
-                    {
-                        "id": t["id"],
-                        "number": t["number"],
-                        "seatingCapacity": t["seatingCapacity"],
-                        "name": t.get("name", f"Стол {t['number']}"),
-                        "x": None,
-                        "y": None,
-                        "width": None,
-                        "height": None
-                    }
-                    for t in section.get("tables", []) if not t.get("isDeleted", False)
-                ]
-            }
-            if section.get("schema"):
-                for table_el in section["schema"].get("tableElements", []):
-                    for t in section_info["tables"]:
-                        if t["id"] == table_el["tableId"]:
-                            t.update({
-                                "x": table_el["x"],
-                                "y": table_el["y"],
-                                "width": table_el["width"],
-                                "height": table_el["height"]
-                            })
-            tables_info.append(section_info)
-
-        return tables_info
-
-    async def fetch_day_reservations(self, date: str):
-        token = update_iiko_token(os.getenv("IIKO_KEY"))
-        section_id = os.getenv("SECTION_ID")
-
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json"
-        }
-
-        payload = {
-            "restaurantSectionIds": [section_id],
-            "dateFrom": f"{date}T00:00:00",
-            "dateTo": f"{date}T23:59:59"
-        }
-
-        response = requests.post(
-            "https://api-ru.iiko.services/api/1/reserve/restaurant_sections_workload",
-            json=payload,
-            headers=headers
-        )
-
-        response.raise_for_status()
-        return response.json().get("reserves", [])
+        sections = [normalize_section(section) for section in data.get("restaurantSections", [])]
+        return data.get("revision", revision), sections
+
+    async def fetch_day_reservations(self, date: str) -> tuple[list, bool]:
+        return await workload_cache.get(date, self.load_day_reservations)
+
+    async def day_occupancy(self, date: str) -> tuple[OccupancyIndex, bool]:
+        # второе значение - загрузка устарела: iiko недоступен, отдали последнюю известную
+        reserves, stale = await self.fetch_day_reservations(date)
+        cached = self._occupancy.get(date)
+        if cached and cached[0] is reserves:
+            return cached[1], stale
+
+        index = OccupancyIndex(reserves)
+        self._occupancy[date] = (reserves, index)
+        first, last = booking_window()
+        for day in [day for day in self._occupancy if not first <= day <= last]:
+            del self._occupancy[day]
+        return index, stale
+
+    async def load_day_reservations(self, date: str):
+        # загрузку на ближайшие дни держит в Redis WorkloadSync; в iiko - только вне окна или без воркера
+        reserves = await read_day(date)
+        if reserves is not None:
+            return reserves
+        try:
+            return await fetch_workload(date, date)
+        except (IikoUnavailable, httpx.HTTPStatusError) as e:
+            if isinstance(e, httpx.HTTPStatusError) and not is_retryable(e.response.status_code):
+                raise
+            # свежий воркер без своего кеша: iiko лежит, но в Redis есть последний снимок дня
+            reserves = await read_day(date, fallback=True)
+            if reserves is None:
+                raise
+            raise StaleWorkload(reserves) from e
 
     async def delete_msg(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        msgs = context.user_data.get("delete_msg", [])
+        # удаление не задерживает ответ: сообщения уходят в фоновую очередь
+        msgs = context.user_data.pop("delete_msg", [])
         if not isinstance(msgs, list):
             msgs = [msgs]
-        for msg_id in msgs:
-            try:
-                await context.bot.delete_message(
-                    chat_id=update.effective_chat.id,
-                    message_id=msg_id
-                )
-            except Exception as e:
-                print(f"Не удалось удалить сообщение {msg_id}: {e}")
+        self.message_cleaner.schedule(update.effective_chat.id, msgs)
 
     # -------------------- Start --------------------
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -205,10 +187,9 @@ class ReservationBot:
             one_time_keyboard=True
         )
 
-    def table_keyboard(self, tables) -> ReplyKeyboardMarkup:
-        tables_json = json.dumps(tables)
-        encoded_tables = urllib.parse.quote(tables_json)
-        url = f"{self.WEB_APP_URL}?tables={encoded_tables}"
+    def table_keyboard(self, layout_version: str) -> ReplyKeyboardMarkup:
+        # Саму схему WebApp забирает из /api/layout/{version}, в URL только версия
+        url = f"{self.WEB_APP_URL}?layout={urllib.parse.quote(layout_version)}"
 
         keyboard = [
             [KeyboardButton("Выбрать стол", web_app=WebAppInfo(url=url))]
@@ -314,10 +295,8 @@ class ReservationBot:
 
         elif action.startswith("confirm_cancel:"):
             _, res_id = action.split(":")
-            await cancel_reservation(res_id)
-            await redis_helpers.delete_reservation_by_id(res_id)
-            await query.edit_message_text("Бронь успешно удалена ✅")
-            await self.show_user_reservations(update, context)
+            # отмену в iiko и удаление заявки доделает воркер заданий, он же обновит сообщение
+            await reservation_jobs.submit(query, "cancel", res_id, "⏳ Отменяем бронь...")
 
         elif action.startswith("deny_cancel"):
             await query.edit_message_text("Отмена удаления броней ❌")
@@ -338,8 +317,7 @@ class ReservationBot:
         elif action.startswith("confirm_no:"):
             _, res_id = action.split(":")
             await update_reservation_confirmation(res_id, "DECLINED")
-            await cancel_reservation(res_id)
-            await query.edit_message_text("❌ Поняли, спасибо что предупредили")
+            await reservation_jobs.submit(query, "decline", res_id, "⏳ Отменяем бронь...")
 
             reservation = await get_reservation_by_id(res_id)
             await notify_admin_to_call(context, reservation)
@@ -356,14 +334,11 @@ class ReservationBot:
 
         other_people = data.get("for_another_person")
 
-        print(other_people)
         if other_people:
             data["step"] = "nophone"
         else:
             data["step"] = "phone"    
 
-        
-        print(data["step"])
         await set_user_data(user_id, data)
 
         if not other_people:
@@ -406,23 +381,17 @@ class ReservationBot:
         await set_user_data(user_id, data)
 
         terminal_group_id = os.getenv("TERMINAL_GROUP_ID")
-        tables = await self.fetch_tables(update_iiko_token(os.getenv("IIKO_KEY")), terminal_group_id)
+        layout = await self.fetch_layout(terminal_group_id)
         
         delete_msg = await context.bot.send_message(
             chat_id=query.from_user.id,
             text="Нажмите на кнопку для выбора стола ⬇️",
-            reply_markup=self.table_keyboard(tables)
+            reply_markup=self.table_keyboard(layout["version"])
         )
         context.user_data['delete_msg'] = delete_msg.message_id
 
-    async def new_reservation_notification(self, reservation_json: str):
-        admin_ids = [int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x]
-        for admin_id in admin_ids:
-            view_key = f"admin_view:{admin_id}"
-            view = self.application.bot_data.get(view_key)
-            
-            if view:
-                await update_admin_list(self.application, view)
+    async def new_reservation_notification(self, event: dict):
+        self.admin_refresher.request()
 
     async def confirm_reservation(self, update: Update, query, context: ContextTypes.DEFAULT_TYPE):
         user_id = query.from_user.id
@@ -484,9 +453,7 @@ class ReservationBot:
 
         web_data = update.message.web_app_data
         payload = json.loads(web_data.data)
-        
-        print("Данные из WebApp:", payload)
-        
+
         if payload.get("action") == "create_reservation":
             data["tableId"] = payload.get("tableId")
             data["table"] = payload.get("tableNumber")
@@ -556,9 +523,7 @@ class ReservationBot:
         await query.answer()
         user_id = query.from_user.id
 
-        reservations = await get_all_reservations()
-
-        user_reservations = [r for r in reservations if (r["user_id"] == user_id and r["status"] == "CONFIRMED")]
+        user_reservations = await get_user_reservations(user_id, "CONFIRMED")
         keyboard1 = []
         keyboard1.append([InlineKeyboardButton("⬅️ Назад", callback_data="back_to_start")])
         if not user_reservations:
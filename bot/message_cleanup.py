@@ -0,0 +1,82 @@
+import asyncio
+import os
+
+from telegram.error import BadRequest, Forbidden
+
+from bot.rate_limiter import PRIORITY_BULK
+
+# deleteMessages принимает до 100 id за вызов
+DELETE_BATCH_SIZE = 100
+CLEANUP_MAX_ATTEMPTS = int(os.getenv("CLEANUP_MAX_ATTEMPTS", 5))
+CLEANUP_RETRY_DELAY = float(os.getenv("CLEANUP_RETRY_DELAY", 2))
+
+
+class MessageCleaner:
+    # Удаляет устаревшие сообщения бота в фоне: обработчик только ставит id в очередь
+    # и сразу отвечает пользователю, а удаление идёт пачками через deleteMessages
+
+    def __init__(self, application):
+        self.application = application
+        # chat_id -> id сообщений, ждущих удаления
+        self._pending: dict[int, set[int]] = {}
+        # chat_id -> номер попытки для того, что не удалилось в прошлый раз
+        self._attempts: dict[int, int] = {}
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def schedule(self, chat_id: int, message_ids):
+        if not message_ids:
+            return
+        self._pending.setdefault(chat_id, set()).update(message_ids)
+        self._wakeup.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while self._pending:
+            self._wakeup.clear()
+            batch, self._pending = self._pending, {}
+            await asyncio.gather(*(self._delete(chat_id, ids) for chat_id, ids in batch.items()))
+
+            # неудачные попытки вернулись в _pending - ждём перед повтором,
+            # новые сообщения разбудят раньше
+            if self._pending and not self._wakeup.is_set():
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=CLEANUP_RETRY_DELAY)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _delete(self, chat_id: int, message_ids: set[int]):
+        ids = sorted(message_ids)
+        failed = []
+        for i in range(0, len(ids), DELETE_BATCH_SIZE):
+            chunk = ids[i:i + DELETE_BATCH_SIZE]
+            try:
+                await self.application.bot.delete_messages(
+                    chat_id=chat_id,
+                    message_ids=chunk,
+                    rate_limit_args={"priority": PRIORITY_BULK}
+                )
+            except (BadRequest, Forbidden) as e:
+                # сообщения старше 48 часов или бот заблокирован - повтор не поможет
+                print(f"Не удалось удалить сообщения {chunk} в чате {chat_id}: {e}")
+            except Exception as e:
+                print(f"Ошибка при удалении сообщений в чате {chat_id}, повторим: {e}")
+                failed.extend(chunk)
+
+        if not failed:
+            self._attempts.pop(chat_id, None)
+            return
+
+        attempt = self._attempts.get(chat_id, 0) + 1
+        if attempt >= CLEANUP_MAX_ATTEMPTS:
+            self._attempts.pop(chat_id, None)
+            print(f"Не удалось удалить сообщения {failed} в чате {chat_id} за {attempt} попыток")
+            return
+        self._attempts[chat_id] = attempt
+        self._pending.setdefault(chat_id, set()).update(failed)
+
+    async def drain(self):
+        # дождаться очереди удаления, например перед остановкой бота
+        while self._task is not None and not self._task.done():
+            await self._task
@@ -0,0 +1,71 @@
+from bisect import bisect_right
+from datetime import datetime, timedelta
+
+DEFAULT_DURATION = 120
+
+
+# Занятость столов за день, собранная один раз из reserves iiko
+class OccupancyIndex:
+    def __init__(self, reserves: list[dict], default_duration: int = DEFAULT_DURATION):
+        intervals: dict[str, list[tuple[datetime, datetime]]] = {}
+        events: list[tuple[datetime, int, str]] = []
+
+        for r in reserves:
+            start = datetime.fromisoformat(r["estimatedStartTime"])
+            end = start + timedelta(minutes=r.get("durationInMinutes") or default_duration)
+            for table_id in r.get("tableIds", []):
+                intervals.setdefault(table_id, []).append((start, end))
+                events.append((start, 1, table_id))
+                events.append((end, -1, table_id))
+
+        # по каждому столу - отсортированные непересекающиеся интервалы
+        self._starts: dict[str, list[datetime]] = {}
+        self._ends: dict[str, list[datetime]] = {}
+        for table_id, table_intervals in intervals.items():
+            table_intervals.sort()
+            starts, ends = [], []
+            for start, end in table_intervals:
+                if ends and start <= ends[-1]:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self._starts[table_id] = starts
+            self._ends[table_id] = ends
+
+        # по всему залу - отрезки [boundary[i], boundary[i+1]) с набором занятых столов
+        self._boundaries: list[datetime] = []
+        self._segments: list[frozenset] = []
+        counts: dict[str, int] = {}
+        events.sort(key=lambda e: (e[0], e[1]))
+        for i, (moment, delta, table_id) in enumerate(events):
+            counts[table_id] = counts.get(table_id, 0) + delta
+            if not counts[table_id]:
+                del counts[table_id]
+            if i + 1 < len(events) and events[i + 1][0] == moment:
+                continue
+            busy = frozenset(counts)
+            if self._segments and self._segments[-1] == busy:
+                continue
+            self._boundaries.append(moment)
+            self._segments.append(busy)
+
+    def busy_at(self, when: datetime) -> frozenset:
+        i = bisect_right(self._boundaries, when) - 1
+        if i < 0:
+            return frozenset()
+        return self._segments[i]
+
+    def is_free(self, table_id: str, start: datetime, duration: int = DEFAULT_DURATION) -> bool:
+        ends = self._ends.get(table_id)
+        if not ends:
+            return True
+
+        # первый интервал стола, который заканчивается после start
+        i = bisect_right(ends, start)
+        if i == len(ends):
+            return True
+        return self._starts[table_id][i] >= start + timedelta(minutes=duration)
+
+    def busy_at_many(self, moments: list[datetime]) -> list[frozenset]:
+        return [self.busy_at(moment) for moment in moments]
@@ -0,0 +1,274 @@
+import asyncio
+import bisect
+import itertools
+import os
+import time
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from monitoring.metrics import TELEGRAM_QUEUE_DEPTH, TELEGRAM_RETRY_AFTER, TELEGRAM_SEND_WAIT
+from redis_config import redis_client as redis
+from redis_config.redis_helpers import script
+
+# Классы приоритета: меньше - раньше. Передаются как rate_limit_args={"priority": ...}
+PRIORITY_USER = 0
+PRIORITY_ADMIN = 1
+PRIORITY_BULK = 2
+PRIORITY_NAMES = {PRIORITY_USER: "user", PRIORITY_ADMIN: "admin", PRIORITY_BULK: "bulk"}
+
+# Лимиты Telegram: ~30 сообщений/с на бота, ~1/с в личный чат, 20/мин в группу
+GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", 30))
+CHAT_RATE = float(os.getenv("TG_CHAT_RATE", 1))
+CHAT_BURST = float(os.getenv("TG_CHAT_BURST", 3))
+GROUP_RATE = float(os.getenv("TG_GROUP_RATE", 20 / 60))
+GROUP_BURST = float(os.getenv("TG_GROUP_BURST", 5))
+MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", 3))
+
+# В webhook-режиме в Telegram пишут несколько процессов (воркеры uvicorn и main.py), а лимиты
+# у бота общие: бакеты и пауза после 429 тогда живут в Redis, каждый процесс берёт токены оттуда
+GLOBAL_BUCKET_KEY = "tg:bucket:global"
+PAUSE_KEY = "tg:paused"
+
+# KEYS[1] - общий бакет, KEYS[2] - бакет чата, KEYS[3] - пауза после 429;
+# ARGV - скорость и ёмкость общего бакета, скорость и ёмкость бакета чата.
+# Время берём у Redis, чтобы часы процессов не расходились.
+# Возвращает {0, 0} - токены взяты из обоих; {1, мс} - ждать лимит чата; {2, мс} - общий лимит или паузу
+TAKE_SCRIPT = """
+local paused = redis.call('PTTL', KEYS[3])
+if paused > 0 then return {2, paused} end
+
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+
+local function level(key, rate, capacity)
+    local state = redis.call('HMGET', key, 'tokens', 'updated')
+    local tokens = tonumber(state[1]) or capacity
+    local updated = tonumber(state[2]) or now
+    return math.min(capacity, tokens + math.max(0, now - updated) * rate)
+end
+
+local global_rate, global_capacity = tonumber(ARGV[1]), tonumber(ARGV[2])
+local chat_rate, chat_capacity = tonumber(ARGV[3]), tonumber(ARGV[4])
+local global = level(KEYS[1], global_rate, global_capacity)
+if global < 1 then return {2, math.ceil((1 - global) / global_rate * 1000)} end
+local chat = level(KEYS[2], chat_rate, chat_capacity)
+if chat < 1 then return {1, math.ceil((1 - chat) / chat_rate * 1000)} end
+
+-- бакет, простоявший дольше полного наполнения, равен полному - хранить его незачем
+redis.call('HSET', KEYS[1], 'tokens', tostring(global - 1), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(global_capacity / global_rate * 1000) + 1000)
+redis.call('HSET', KEYS[2], 'tokens', tostring(chat - 1), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[2], math.ceil(chat_capacity / chat_rate * 1000) + 1000)
+return {0, 0}
+"""
+
+
+def chat_bucket_key(chat_id) -> str:
+    return f"tg:bucket:chat:{chat_id}"
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class PriorityRateLimiter(BaseRateLimiter[dict]):
+    def __init__(self, max_retries: int = MAX_RETRIES, distributed: bool = False):
+        self.max_retries = max_retries
+        # distributed - лимиты общие для всех процессов, бакеты в Redis; локальные
+        # остаются запасным вариантом, пока Redis недоступен
+        self.distributed = distributed
+        self._global = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+        self._chats: dict[object, TokenBucket] = {}
+        # отсортированная очередь (priority, seq, chat_id, future)
+        self._queue: list = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._paused_until = 0.0
+        self._dispatcher: asyncio.Task | None = None
+
+    async def initialize(self):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+        for *_, future in self._queue:
+            future.cancel()
+        self._queue.clear()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        priority = (rate_limit_args or {}).get("priority", PRIORITY_USER)
+
+        for attempt in range(self.max_retries + 1):
+            if chat_id is None:
+                # answerCallbackQuery и прочее без чата не троттлим, только уважаем паузу после 429
+                delay = self._paused_until - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            else:
+                await self._acquire(chat_id, priority)
+
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                TELEGRAM_RETRY_AFTER.inc()
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                if self.distributed:
+                    await self._pause_shared(retry_after)
+                self._wakeup.set()
+                if attempt == self.max_retries:
+                    raise
+
+    async def _acquire(self, chat_id, priority: int):
+        future = asyncio.get_running_loop().create_future()
+        bisect.insort(self._queue, (priority, next(self._seq), chat_id, future), key=lambda t: t[:2])
+        self._wakeup.set()
+
+        queued_at = time.monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            self._queue[:] = [t for t in self._queue if t[3] is not future]
+            raise
+        TELEGRAM_SEND_WAIT.labels(PRIORITY_NAMES.get(priority, str(priority))).observe(time.monotonic() - queued_at)
+
+    def _bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if is_group(chat_id):
+                bucket = TokenBucket(GROUP_RATE, GROUP_BURST)
+            else:
+                bucket = TokenBucket(CHAT_RATE, CHAT_BURST)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _dispatch(self):
+        while True:
+            TELEGRAM_QUEUE_DEPTH.set(len(self._queue))
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            wait = max(self._paused_until - now, 0 if self.distributed else self._global.delay(now))
+            if wait <= 0:
+                if self.distributed:
+                    try:
+                        wait = await self._release_next_shared()
+                    except Exception as e:
+                        print(f"Лимиты Telegram в Redis недоступны, считаем локально: {e}")
+                        wait = self._release_next(now)
+                else:
+                    wait = self._release_next(now)
+            if wait is None:
+                continue
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def _release_next(self, now: float) -> float | None:
+        # первый по приоритету запрос, чей чат не упёрся в свой лимит
+        chat_wait = None
+        for i, (_, _, chat_id, future) in enumerate(self._queue):
+            if future.done():
+                continue
+            bucket = self._bucket(chat_id)
+            delay = bucket.delay(now)
+            if delay > 0:
+                chat_wait = delay if chat_wait is None else min(chat_wait, delay)
+                continue
+
+            bucket.consume(now)
+            self._global.consume(now)
+            del self._queue[i]
+            future.set_result(None)
+            self._prune(now)
+            return None
+
+        self._queue[:] = [t for t in self._queue if not t[3].done()]
+        return chat_wait if chat_wait is not None else 0.05
+
+    async def _release_next_shared(self) -> float | None:
+        # то же, что _release_next, но токены берутся из общих бакетов в Redis
+        take = script(TAKE_SCRIPT)
+        chat_wait = None
+        limited = set()
+        # пока ждём Redis, очередь могут пополнить или отменить запросы - идём по снимку
+        for entry in list(self._queue):
+            _, _, chat_id, future = entry
+            if future.done() or chat_id in limited:
+                continue
+            if is_group(chat_id):
+                rate, burst = GROUP_RATE, GROUP_BURST
+            else:
+                rate, burst = CHAT_RATE, CHAT_BURST
+            status, wait_ms = await take(
+                keys=[GLOBAL_BUCKET_KEY, chat_bucket_key(chat_id), PAUSE_KEY],
+                args=[GLOBAL_RATE, GLOBAL_RATE, rate, burst]
+            )
+            if status == 2:
+                return wait_ms / 1000
+            if status == 1:
+                limited.add(chat_id)
+                chat_wait = wait_ms / 1000 if chat_wait is None else min(chat_wait, wait_ms / 1000)
+                continue
+
+            if entry in self._queue:
+                self._queue.remove(entry)
+            if not future.done():
+                future.set_result(None)
+            return None
+
+        self._queue[:] = [t for t in self._queue if not t[3].done()]
+        return chat_wait if chat_wait is not None else 0.05
+
+    async def _pause_shared(self, retry_after: float):
+        try:
+            await redis.redis_client.set(PAUSE_KEY, 1, px=max(int(retry_after * 1000), 1))
+        except Exception as e:
+            print(f"Не удалось сохранить паузу Telegram в Redis: {e}")
+
+    def _prune(self, now: float):
+        if len(self._chats) > 10000:
+            self._chats = {chat_id: b for chat_id, b in self._chats.items() if not b.is_idle(now)}
+
+
+def is_group(chat_id) -> bool:
+    if isinstance(chat_id, str):
+        return chat_id.startswith("@") or chat_id.startswith("-")
+    return chat_id < 0
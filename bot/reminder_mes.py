@@ -1,15 +1,57 @@
+import asyncio
+import os
+import random
+import time
 from datetime import datetime, timedelta
-from telegram import Update
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.jobstores.redis import RedisJobStore
+from redis_config import redis_client as redis
+from monitoring.metrics import SCHEDULER_LAG
 from redis_config.redis_helpers import get_reservation_by_id, update_reservation_confirmation
 
-scheduler = AsyncIOScheduler()
-
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
-async def send_confirmation_request(context, reservation):
-    print("ЭЭЭЭХХ БЛЯЯЯЯЯЯЯЯЯ")
+# Напоминания лежат в sorted set'е: member = "{kind}:{reservation_id}", score = время срабатывания.
+# Забранные sweeper'ом задачи переезжают в processing с дедлайном, чтобы при падении
+# процесса посреди обработки они вернулись в очередь, а не потерялись. Упавший обработчик
+# возвращает напоминание в очередь с растущей паузой; счётчик попыток - в attempts.
+REMINDERS_KEY = "reminders:due"
+PROCESSING_KEY = "reminders:processing"
+ATTEMPTS_KEY = "reminders:attempts"
+
+SWEEP_INTERVAL = float(os.getenv("REMINDER_SWEEP_INTERVAL", 1))
+SWEEP_BATCH = int(os.getenv("REMINDER_SWEEP_BATCH", 100))
+PROCESSING_LEASE = int(os.getenv("REMINDER_PROCESSING_LEASE", 5 * 60))
+REMINDER_MAX_ATTEMPTS = int(os.getenv("REMINDER_MAX_ATTEMPTS", 5))
+REMINDER_RETRY_BASE_DELAY = float(os.getenv("REMINDER_RETRY_BASE_DELAY", 10))
+REMINDER_RETRY_MAX_DELAY = float(os.getenv("REMINDER_RETRY_MAX_DELAY", 5 * 60))
+
+# KEYS[1] - очередь, KEYS[2] - processing; ARGV[1] - сейчас, ARGV[2] - размер пачки, ARGV[3] - дедлайн.
+# Возвращает member, score, member, score... - по score считаем опоздание срабатывания
+CLAIM_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, member in ipairs(expired) do
+    redis.call('ZREM', KEYS[2], member)
+    redis.call('ZADD', KEYS[1], ARGV[1], member)
+end
+
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'WITHSCORES', 'LIMIT', 0, ARGV[2])
+for i = 1, #due, 2 do
+    redis.call('ZREM', KEYS[1], due[i])
+    redis.call('ZADD', KEYS[2], ARGV[3], due[i])
+end
+return due
+"""
+
+
+def reminder_retry_delay(attempt: int) -> float:
+    delay = min(REMINDER_RETRY_MAX_DELAY, REMINDER_RETRY_BASE_DELAY * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+
+async def send_confirmation_request(application, reservation_id):
+    reservation = await get_reservation_by_id(reservation_id)
+    if not reservation:
+        return
+
     keyboard = InlineKeyboardMarkup([
         [
             InlineKeyboardButton("✅ Да", callback_data=f"confirm_yes:{reservation['id']}"),
@@ -17,7 +59,7 @@ async def send_confirmation_request(context, reservation):
         ]
     ])
 
-    msg = await context.bot.send_message(
+    msg = await application.bot.send_message(
         chat_id=reservation["user_id"],
         text=(
             "⏰ Напоминание о брони!\n\n"
@@ -34,40 +76,122 @@ async def send_confirmation_request(context, reservation):
         message_id=msg.message_id
     )
 
-    scheduler.add_job(
-        confirmation_timeout,
-        trigger="date",
-        run_date=datetime.now() + timedelta(minutes=15),
-        args=[context, reservation["id"]],
-        misfire_grace_time=60
+    await reminder_engine.schedule(
+        "confirmation_timeout",
+        reservation["id"],
+        datetime.now() + timedelta(minutes=15)
     )
 
-def schedule_reservation_reminders(context, reservation):
-    print("Ждём 5 минут")
+async def schedule_reservation_reminders(reservation):
     reservation_time = datetime.fromisoformat(
         f"{reservation['date']}T{reservation['time']}"
     )
 
+    # за два часа до брони; если бронь ближе - не спрашиваем
     confirm_time = reservation_time - timedelta(hours=2)
-    run_date = datetime.now() + timedelta(minutes=5)
-    if run_date > datetime.now():
-        print("ZA:UPA")
-        scheduler.add_job(
-            send_confirmation_request,
-            trigger="date",
-            run_date=run_date,
-            args=[context, reservation],
-            misfire_grace_time=60
-        )
-
-async def confirmation_timeout(context, reservation_id):
+    if confirm_time > datetime.now():
+        await reminder_engine.schedule("confirmation_request", reservation["id"], confirm_time)
+
+async def confirmation_timeout(application, reservation_id):
     from admin.comands import notify_admin_to_call
     reservation = await get_reservation_by_id(reservation_id)
     if not reservation:
         return
 
-    if reservation.get("confirmation_status") == "WAITING":
-        await update_reservation_confirmation(reservation_id, "NO_RESPONSE")
-        await notify_admin_to_call(context, reservation)
+    # гость мог ответить, пока срабатывал таймер - меняем статус только из WAITING
+    if await update_reservation_confirmation(reservation_id, "NO_RESPONSE", expected="WAITING"):
+        reservation["confirmation_status"] = "NO_RESPONSE"
+        await notify_admin_to_call(application, reservation)
+
+
+class ReminderEngine:
+    def __init__(self, handlers: dict):
+        self.handlers = handlers
+        self.application = None
+        self._task: asyncio.Task | None = None
+
+    async def schedule(self, kind: str, reservation_id: str, run_at: datetime):
+        await redis.redis_client.zadd(REMINDERS_KEY, {f"{kind}:{reservation_id}": run_at.timestamp()})
+
+    async def cancel(self, reservation_id: str):
+        members = [f"{kind}:{reservation_id}" for kind in self.handlers]
+        async with redis.redis_client.pipeline(transaction=False) as pipe:
+            pipe.zrem(REMINDERS_KEY, *members)
+            pipe.hdel(ATTEMPTS_KEY, *members)
+            await pipe.execute()
+
+    def start(self, application):
+        self.application = application
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        claim = redis.redis_client.register_script(CLAIM_SCRIPT)
+        while True:
+            try:
+                now = time.time()
+                due = await claim(
+                    keys=[REMINDERS_KEY, PROCESSING_KEY],
+                    args=[now, SWEEP_BATCH, now + PROCESSING_LEASE]
+                )
+                members = due[::2]
+                if members:
+                    fired = await asyncio.gather(*(
+                        self._fire(member, now - float(score)) for member, score in zip(members, due[1::2])
+                    ))
+                    # неудачные _fire уже сам вернул в очередь
+                    done = [member for member, ok in zip(members, fired) if ok]
+                    if done:
+                        async with redis.redis_client.pipeline(transaction=False) as pipe:
+                            pipe.zrem(PROCESSING_KEY, *done)
+                            pipe.hdel(ATTEMPTS_KEY, *done)
+                            await pipe.execute()
+            except Exception as e:
+                print(f"Ошибка обработки напоминаний: {e}")
+                members = []
+
+            # полная пачка - скорее всего есть ещё просроченные, забираем сразу
+            if len(members) < SWEEP_BATCH:
+                await asyncio.sleep(SWEEP_INTERVAL)
+
+    async def _fire(self, member: str, lag: float) -> bool:
+        # False - обработчик упал, напоминание отложено или снято после последней попытки
+        kind, reservation_id = member.split(":", 1)
+        handler = self.handlers.get(kind)
+        if handler is None:
+            return True
+        SCHEDULER_LAG.labels(kind).observe(max(lag, 0))
+        try:
+            await handler(self.application, reservation_id)
+        except Exception as e:
+            await self._retry(member, e)
+            return False
+        return True
+
+    async def _retry(self, member: str, error: Exception):
+        attempts = await redis.redis_client.hincrby(ATTEMPTS_KEY, member, 1)
+        async with redis.redis_client.pipeline(transaction=True) as pipe:
+            pipe.zrem(PROCESSING_KEY, member)
+            if attempts >= REMINDER_MAX_ATTEMPTS:
+                print(f"Напоминание {member} не выполнено после {attempts} попыток: {error}")
+                pipe.hdel(ATTEMPTS_KEY, member)
+            else:
+                print(f"Напоминание {member} будет повторено: {error}")
+                # nx: если напоминание успели переназначить, новое время важнее
+                pipe.zadd(REMINDERS_KEY, {member: time.time() + reminder_retry_delay(attempts - 1)}, nx=True)
+            await pipe.execute()
 
 
+reminder_engine = ReminderEngine({
+    "confirmation_request": send_confirmation_request,
+    "confirmation_timeout": confirmation_timeout,
+})
@@ -0,0 +1,362 @@
+import asyncio
+import json
+import os
+import random
+import time
+
+import httpx
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from iiko_client.client import is_retryable
+from monitoring.metrics import RESERVATION_JOBS
+from redis_config import redis_client as redis
+from redis_config.redis_helpers import (
+    get_reservation_by_id, update_reservation_status, delete_reservation_by_id, set_reservation_fields, script
+)
+from bot.reminder_mes import reminder_engine, schedule_reservation_reminders
+
+# Записи в iiko (создание и отмена брони) не выполняются в обработчике кнопки: задание
+# ложится в Redis, обработчик сразу отвечает «обрабатываем», а воркер доводит запись
+# до конца и редактирует то же сообщение. Устроено как напоминания: due - sorted set
+# с временем запуска, processing - с дедлайном аренды, чтобы задание упавшего процесса
+# вернулось в очередь. id задания - "{группа}:{reservation_id}", повторное нажатие не дублирует его.
+JOBS_KEY = "iiko:jobs:due"
+PROCESSING_KEY = "iiko:jobs:processing"
+
+JOB_WORKERS = int(os.getenv("RESERVATION_JOB_WORKERS", 4))
+JOB_POLL_INTERVAL = float(os.getenv("RESERVATION_JOB_POLL_INTERVAL", 0.5))
+JOB_LEASE = int(os.getenv("RESERVATION_JOB_LEASE", 2 * 60))
+JOB_MAX_ATTEMPTS = int(os.getenv("RESERVATION_JOB_MAX_ATTEMPTS", 8))
+JOB_RETRY_BASE_DELAY = float(os.getenv("RESERVATION_JOB_RETRY_BASE_DELAY", 5))
+JOB_RETRY_MAX_DELAY = float(os.getenv("RESERVATION_JOB_RETRY_MAX_DELAY", 5 * 60))
+
+# решения по одной заявке делят ключ: отклонить, пока создаётся бронь в iiko, нельзя
+JOB_GROUPS = {"approve": "decision", "reject": "decision"}
+
+# KEYS[1] - задание, KEYS[2] - очередь; ARGV[1] - id, ARGV[2] - задание в JSON, ARGV[3] - сейчас.
+# Возвращает nil, если задание поставлено, иначе - уже стоящее задание
+ENQUEUE_SCRIPT = """
+if redis.call('SET', KEYS[1], ARGV[2], 'NX') then
+    redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+    return false
+end
+return redis.call('GET', KEYS[1])
+"""
+
+# KEYS[1] - очередь, KEYS[2] - processing; ARGV[1] - сейчас, ARGV[2] - дедлайн.
+# Забирает одно задание, предварительно вернув в очередь задания с истёкшей арендой
+CLAIM_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, 100)
+for _, member in ipairs(expired) do
+    redis.call('ZREM', KEYS[2], member)
+    redis.call('ZADD', KEYS[1], ARGV[1], member)
+end
+
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, 1)
+if #due == 0 then return false end
+redis.call('ZREM', KEYS[1], due[1])
+redis.call('ZADD', KEYS[2], ARGV[2], due[1])
+return due[1]
+"""
+
+
+class RetryJob(Exception):
+    pass
+
+
+class JobFailed(Exception):
+    # аргумент - текст для сообщения; без него берётся общий текст ошибки задания
+    pass
+
+
+def job_key(job_id: str) -> str:
+    return f"iiko:job:{job_id}"
+
+
+def job_retry_delay(attempt: int) -> float:
+    delay = min(JOB_RETRY_MAX_DELAY, JOB_RETRY_BASE_DELAY * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+
+def back_to_admin_list() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton("📋 К списку", callback_data="view_reservations")]])
+
+
+def back_to_user_reservations() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("📋 Мои брони", callback_data="my_reservations")],
+        [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_start")]
+    ])
+
+
+async def create_in_iiko(reservation: dict) -> str:
+    from admin.comands import create_reserve, find_reserve
+
+    # Отметку ставим до create: если iiko принял бронь, а ответ потерялся (таймаут, падение
+    # воркера), повтор сначала ищет её в iiko и не создаёт вторую
+    if reservation.get("iiko_create_at"):
+        reserve = await find_reserve(reservation["id"])
+        if reserve is not None:
+            return reserve["id"]
+    elif not await set_reservation_fields(reservation["id"], {"iiko_create_at": time.time()}, expected_status="PENDING"):
+        raise JobFailed("❌ Заявка уже обработана")
+
+    result = await create_reserve({
+        "id": reservation["id"],
+        "name": reservation["name"],
+        "phone": reservation["phone"],
+        "table_id": reservation["tableId"],
+        "table": reservation["table"],
+        "guests": reservation["guests"],
+        "date": reservation["date"],
+        "time": reservation["time"]
+    })
+    if result["status"] != "created":
+        if is_retryable(result["status_code"]):
+            raise RetryJob(f"iiko create {result['status_code']}: {result['error']}")
+        print(f"iiko отказал в создании брони {reservation['id']}: {result['error']}")
+        raise JobFailed()
+    return result["iiko"]["reserveInfo"]["id"]
+
+
+async def notify_guest_approved(application, reservation: dict):
+    # отдельный шаг со своей отметкой: если сообщение не ушло, повтор задания
+    # застанет бронь подтверждённой и допошлёт только его
+    if reservation.get("guest_notified"):
+        return
+    await schedule_reservation_reminders(reservation)
+    await application.bot.send_message(
+        chat_id=reservation["user_id"],
+        text=(
+            "✅ Ваша заявка подтверждена!\n\n"
+            f"📅 {reservation['date']} {reservation['time']}\n"
+            f"🍽 Стол: {reservation['table']}\n"
+            f"👥 Кол-во гостей: {reservation['guests']}\n"
+        )
+    )
+    await set_reservation_fields(reservation["id"], {"guest_notified": True}, expected_status="CONFIRMED")
+
+
+async def approve_reservation(application, job: dict):
+    from iiko_client.workload_cache import workload_cache
+
+    reservation = await get_reservation_by_id(job["reservation_id"])
+    if not reservation:
+        raise JobFailed("❌ Заявка не найдена")
+
+    admin_text = (
+        "✅ Бронь создана\n\n"
+        f"👤 {reservation['name']}\n"
+        f"📅 {reservation['date']} {reservation['time']}\n"
+        f"🍽 Стол {reservation['table']}\n"
+    )
+    # повтор после сбоя между подтверждением и сообщением гостю - бронь в iiko уже есть
+    if reservation["status"] == "CONFIRMED":
+        await notify_guest_approved(application, reservation)
+        return admin_text, back_to_admin_list()
+    if reservation["status"] != "PENDING":
+        raise JobFailed("❌ Заявка уже обработана")
+
+    iiko_id = await create_in_iiko(reservation)
+    await workload_cache.invalidate(reservation["date"])
+
+    if await update_reservation_status(reservation["id"], "CONFIRMED", iiko_id, expected="PENDING"):
+        await notify_guest_approved(application, reservation)
+    return admin_text, back_to_admin_list()
+
+
+async def reject_reservation(application, job: dict):
+    reservation = await get_reservation_by_id(job["reservation_id"])
+    if not reservation:
+        raise JobFailed("❌ Заявка не найдена")
+    if not await delete_reservation_by_id(reservation["id"], event="rejected", expected="PENDING"):
+        raise JobFailed("❌ Заявка уже обработана")
+
+    await application.bot.send_message(
+        chat_id=reservation["user_id"],
+        text=(
+            "❌ К сожалению, ваша заявка отклонена.\n"
+            f"📅 {reservation['date']} {reservation['time']}\n"
+            f"🍽 Стол: {reservation['table']}\n"
+            f"👥 Кол-во гостей: {reservation['guests']}\n\n"
+            "Попробуйте выбрать другое время или другой стол."
+        )
+    )
+    return (
+        "❌ Заявка отклонена\n\n"
+        f"👤 {reservation['name']}\n"
+        f"📅 {reservation['date']} {reservation['time']}\n"
+        f"🍽 Стол {reservation['table']}\n"
+    ), back_to_admin_list()
+
+
+async def cancel_in_iiko(reservation: dict):
+    from admin.comands import cancel_reservation
+
+    # заявку, которую ещё не приняли, в iiko отменять нечего
+    if not reservation.get("id_iiko"):
+        return
+    # 400 - бронь в iiko уже отменена (в том числе нашей прошлой попыткой), дальше можно удалять
+    try:
+        await cancel_reservation(reservation["id"])
+    except httpx.HTTPStatusError as e:
+        if is_retryable(e.response.status_code):
+            raise
+        print(f"iiko отказал в отмене брони {reservation['id']}: {e.response.status_code}")
+        raise JobFailed() from e
+
+
+async def cancel_guest_reservation(application, job: dict):
+    reservation = await get_reservation_by_id(job["reservation_id"])
+    if reservation:
+        await cancel_in_iiko(reservation)
+        await delete_reservation_by_id(reservation["id"])
+        await reminder_engine.cancel(reservation["id"])
+    return "Бронь успешно удалена ✅", back_to_user_reservations()
+
+
+async def decline_reservation(application, job: dict):
+    reservation = await get_reservation_by_id(job["reservation_id"])
+    if reservation:
+        await cancel_in_iiko(reservation)
+    return "❌ Поняли, спасибо что предупредили", None
+
+
+class ReservationJobQueue:
+    def __init__(self, handlers: dict, failures: dict, workers: int = JOB_WORKERS):
+        self.handlers = handlers
+        # kind -> (текст, клавиатура), которыми заменяется «обрабатываем», если задание не выполнилось
+        self.failures = failures
+        self.workers = workers
+        self.application = None
+        self._tasks: list[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+
+    async def enqueue(self, kind: str, reservation_id: str, chat_id: int, message_id: int) -> dict | None:
+        # None - задание поставлено; иначе - задание по этой заявке, которое уже в очереди или выполняется
+        job_id = f"{JOB_GROUPS.get(kind, kind)}:{reservation_id}"
+        job = {
+            "kind": kind,
+            "reservation_id": reservation_id,
+            "chat_id": chat_id,
+            "message_id": message_id,
+            "attempts": 0
+        }
+        queued = await script(ENQUEUE_SCRIPT)(
+            keys=[job_key(job_id), JOBS_KEY],
+            args=[job_id, json.dumps(job), time.time()]
+        )
+        if queued is None:
+            self._wakeup.set()
+            return None
+        return json.loads(queued)
+
+    async def submit(self, query, kind: str, reservation_id: str, text: str):
+        # «обрабатываем» показываем до постановки: иначе быстрый воркер успел бы
+        # отредактировать сообщение раньше, и мы затёрли бы результат
+        await query.edit_message_text(text)
+        chat_id, message_id = query.message.chat_id, query.message.message_id
+        queued = await self.enqueue(kind, reservation_id, chat_id, message_id)
+        # повторное нажатие в том же сообщении - его и так обновит стоящее задание
+        if queued is not None and (queued["chat_id"], queued["message_id"]) != (chat_id, message_id):
+            await query.edit_message_text(
+                "⏳ Заявка уже обрабатывается", reply_markup=self.failures[kind][1]
+            )
+
+    def start(self, application):
+        self.application = application
+        self._tasks = [task for task in self._tasks if not task.done()]
+        while len(self._tasks) < self.workers:
+            self._tasks.append(asyncio.create_task(self._run()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+
+    async def _run(self):
+        claim = redis.redis_client.register_script(CLAIM_SCRIPT)
+        while True:
+            job_id = None
+            try:
+                now = time.time()
+                job_id = await claim(keys=[JOBS_KEY, PROCESSING_KEY], args=[now, now + JOB_LEASE])
+                if job_id:
+                    await self._process(job_id)
+            except Exception as e:
+                print(f"Ошибка обработки заданий iiko: {e}")
+
+            if not job_id:
+                # задания из этого процесса будят воркеры сразу, из других - подхватываются опросом
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _process(self, job_id: str):
+        raw = await redis.redis_client.get(job_key(job_id))
+        if raw is None:
+            await redis.redis_client.zrem(PROCESSING_KEY, job_id)
+            return
+        job = json.loads(raw)
+
+        try:
+            text, markup = await self.handlers[job["kind"]](self.application, job)
+        except JobFailed as e:
+            text, markup = self.failures[job["kind"]]
+            await self._finish(job_id, job, "failed", e.args[0] if e.args else text, markup)
+        except Exception as e:
+            # RetryJob, недоступный iiko, сбой сети или Redis - пробуем позже с растущей паузой
+            job["attempts"] += 1
+            if job["attempts"] >= JOB_MAX_ATTEMPTS:
+                print(f"Задание {job_id} не выполнено после {job['attempts']} попыток: {e}")
+                await self._finish(job_id, job, "failed", *self.failures[job["kind"]])
+                return
+            print(f"Задание {job_id} будет повторено: {e}")
+            RESERVATION_JOBS.labels(job["kind"], "retry").inc()
+            async with redis.redis_client.pipeline(transaction=True) as pipe:
+                pipe.set(job_key(job_id), json.dumps(job))
+                pipe.zrem(PROCESSING_KEY, job_id)
+                pipe.zadd(JOBS_KEY, {job_id: time.time() + job_retry_delay(job["attempts"] - 1)})
+                await pipe.execute()
+        else:
+            await self._finish(job_id, job, "done", text, markup)
+
+    async def _finish(self, job_id: str, job: dict, result: str, text: str, markup):
+        RESERVATION_JOBS.labels(job["kind"], result).inc()
+        async with redis.redis_client.pipeline(transaction=True) as pipe:
+            pipe.delete(job_key(job_id))
+            pipe.zrem(PROCESSING_KEY, job_id)
+            await pipe.execute()
+
+        try:
+            await self.application.bot.edit_message_text(
+                chat_id=job["chat_id"],
+                message_id=job["message_id"],
+                text=text,
+                reply_markup=markup
+            )
+        except Exception as e:
+            print(f"Не удалось обновить сообщение задания {job_id}: {e}")
+
+
+reservation_jobs = ReservationJobQueue(
+    {
+        "approve": approve_reservation,
+        "reject": reject_reservation,
+        "cancel": cancel_guest_reservation,
+        "decline": decline_reservation,
+    },
+    {
+        "approve": ("❌ Ошибка при создании брони в iiko", back_to_admin_list()),
+        "reject": ("❌ Не удалось отклонить заявку", back_to_admin_list()),
+        "cancel": ("❌ Не удалось отменить бронь, попробуйте позже", back_to_user_reservations()),
+        "decline": ("❌ Не удалось отменить бронь, администратор свяжется с вами", None),
+    }
+)
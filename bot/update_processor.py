@@ -0,0 +1,97 @@
+import asyncio
+import os
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from redis_config.redis_helpers import acquire_lock, release_lock, renew_lock
+
+# Сколько обновлений реально обрабатывается одновременно (бережём Redis и iiko)
+BOT_CONCURRENCY = int(os.getenv("BOT_CONCURRENCY", 16))
+# Сколько обновлений может ждать своей очереди; семафор PTB берётся до нашей блокировки,
+# поэтому он должен быть заметно больше BOT_CONCURRENCY
+BOT_MAX_PENDING_UPDATES = int(os.getenv("BOT_MAX_PENDING_UPDATES", 1024))
+# В webhook-режиме обновления одного пользователя приходят в разные воркеры uvicorn -
+# очередь пользователя держится ещё и блокировкой в Redis. TTL - на случай падения воркера:
+# пока обработчик жив, блокировка продлевается каждую треть TTL, сколько бы он ни работал
+UPDATE_LOCK_TTL_MS = int(os.getenv("UPDATE_LOCK_TTL_MS", 30 * 1000))
+UPDATE_LOCK_POLL = float(os.getenv("UPDATE_LOCK_POLL", 0.01))
+# Дольше не ждём: держатель, видимо, завис - обновление обрабатываем без блокировки,
+# чтобы пользователь не застрял
+UPDATE_LOCK_TIMEOUT = float(os.getenv("UPDATE_LOCK_TIMEOUT", 2 * 60))
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # Разные пользователи обрабатываются параллельно, обновления одного пользователя - строго
+    # по очереди, чтобы get_user_data -> изменение -> set_user_data не перетирали друг друга
+
+    def __init__(self, concurrency: int = BOT_CONCURRENCY, max_pending: int = BOT_MAX_PENDING_UPDATES,
+                 distributed: bool = False):
+        super().__init__(max(max_pending, concurrency))
+        self.distributed = distributed
+        self._workers = asyncio.Semaphore(concurrency)
+        # key -> [lock, число ожидающих]; запись удаляется, когда очередь пользователя пуста
+        self._locks: dict[int, list] = {}
+
+    async def do_process_update(self, update, coroutine):
+        key = serialization_key(update)
+        if key is None:
+            async with self._workers:
+                await coroutine
+            return
+
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                if not self.distributed:
+                    async with self._workers:
+                        await coroutine
+                    return
+
+                lock_key = f"update_lock:{key}"
+                token = await acquire_lock(lock_key, UPDATE_LOCK_TTL_MS, UPDATE_LOCK_TIMEOUT, UPDATE_LOCK_POLL)
+                if token is None:
+                    print(f"Не дождались блокировки {lock_key}, обрабатываем без неё")
+                    async with self._workers:
+                        await coroutine
+                    return
+
+                keeper = asyncio.create_task(keep_lock(lock_key, token))
+                try:
+                    async with self._workers:
+                        await coroutine
+                finally:
+                    keeper.cancel()
+                    await release_lock(lock_key, token)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                self._locks.pop(key, None)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+async def keep_lock(lock_key: str, token: str):
+    while True:
+        await asyncio.sleep(UPDATE_LOCK_TTL_MS / 3000)
+        try:
+            if not await renew_lock(lock_key, token, UPDATE_LOCK_TTL_MS):
+                print(f"Блокировка {lock_key} истекла во время обработки")
+                return
+        except Exception as e:
+            print(f"Не удалось продлить блокировку {lock_key}: {e}")
+
+
+def serialization_key(update) -> int | None:
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
@@ -0,0 +1,190 @@
+import asyncio
+import os
+import random
+import time
+
+import httpx
+from dotenv import load_dotenv
+
+from monitoring.metrics import IIKO_BREAKER_OPEN, IIKO_LATENCY, IIKO_RESPONSES, IIKO_RETRIES
+
+load_dotenv()
+
+IIKO_WORKLOAD_URL = os.getenv(
+    "IIKO_WORKLOAD_URL",
+    "https://api-ru.iiko.services/api/1/reserve/restaurant_sections_workload"
+)
+IIKO_RESERVE_STATUS_URL = os.getenv(
+    "IIKO_RESERVE_STATUS_URL",
+    "https://api-ru.iiko.services/api/1/reserve/status_by_id"
+)
+
+# endpoint -> (url, общий таймаут в секундах)
+ENDPOINTS = {
+    "token": (os.getenv("IIKO_TOKEN_URL"), float(os.getenv("IIKO_TOKEN_TIMEOUT", 10))),
+    "tables": (os.getenv("IIKO_API_URL"), float(os.getenv("IIKO_TABLES_TIMEOUT", 10))),
+    "workload": (IIKO_WORKLOAD_URL, float(os.getenv("IIKO_WORKLOAD_TIMEOUT", 10))),
+    "create": (os.getenv("IIKO_CREATE_URL"), float(os.getenv("IIKO_CREATE_TIMEOUT", 15))),
+    "cancel": (os.getenv("IIKO_CANCEL_URL"), float(os.getenv("IIKO_CANCEL_TIMEOUT", 15))),
+    "reserve_status": (IIKO_RESERVE_STATUS_URL, float(os.getenv("IIKO_RESERVE_STATUS_TIMEOUT", 10))),
+}
+
+CONNECT_TIMEOUT = float(os.getenv("IIKO_CONNECT_TIMEOUT", 5))
+MAX_CONNECTIONS = int(os.getenv("IIKO_MAX_CONNECTIONS", 20))
+MAX_KEEPALIVE = int(os.getenv("IIKO_MAX_KEEPALIVE", 10))
+HTTP2 = os.getenv("IIKO_HTTP2", "1") == "1"
+
+# Повторяем только то, что можно безопасно отправить дважды: логин и чтения.
+# create/cancel здесь не повторяем: их повторяет очередь заданий (bot/reservation_jobs.py),
+# которая перед повторным create ищет бронь, созданную прошлой попыткой
+IDEMPOTENT_ENDPOINTS = {"token", "tables", "workload", "reserve_status"}
+READ_RETRIES = int(os.getenv("IIKO_READ_RETRIES", 2))
+RETRY_BASE_DELAY = float(os.getenv("IIKO_RETRY_BASE_DELAY", 0.2))
+RETRY_MAX_DELAY = float(os.getenv("IIKO_RETRY_MAX_DELAY", 2))
+
+# Столько сбоев подряд размыкают предохранитель; разомкнутый он отказывает сразу,
+# а по истечении паузы пропускает один пробный запрос
+BREAKER_THRESHOLD = int(os.getenv("IIKO_BREAKER_THRESHOLD", 5))
+BREAKER_COOLDOWN = float(os.getenv("IIKO_BREAKER_COOLDOWN", 30))
+
+
+class IikoUnavailable(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, threshold: int = BREAKER_THRESHOLD, cooldown: float = BREAKER_COOLDOWN):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._probing = False
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at < self.cooldown or self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        IIKO_BREAKER_OPEN.labels(self.name).set(0)
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+            IIKO_BREAKER_OPEN.labels(self.name).set(1)
+
+    def abandon(self):
+        # пробный запрос отменили - ответа не было, пусть попробует следующий
+        self._probing = False
+
+
+def is_retryable(status_code: int) -> bool:
+    return status_code >= 500 or status_code == 429
+
+
+def retry_delay(attempt: int) -> float:
+    # full jitter: повторы от разных корутин не бьют в iiko одновременно
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+class IikoClient:
+    def __init__(self, endpoints: dict = ENDPOINTS):
+        self.endpoints = endpoints
+        self.breakers = {endpoint: CircuitBreaker(endpoint) for endpoint in endpoints}
+        self._client: httpx.AsyncClient | None = None
+
+    async def start(self):
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                http2=HTTP2,
+                limits=httpx.Limits(
+                    max_connections=MAX_CONNECTIONS,
+                    max_keepalive_connections=MAX_KEEPALIVE,
+                    keepalive_expiry=60
+                ),
+                headers={"Content-Type": "application/json"}
+            )
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def post(self, endpoint: str, json: dict, auth: bool = True) -> httpx.Response:
+        # Клиент открывается на старте приложения, но на всякий случай поднимаем его лениво
+        await self.start()
+        breaker = self.breakers[endpoint]
+        attempts = 1 + (READ_RETRIES if endpoint in IDEMPOTENT_ENDPOINTS else 0)
+
+        for attempt in range(attempts):
+            if attempt:
+                IIKO_RETRIES.labels(endpoint).inc()
+                await asyncio.sleep(retry_delay(attempt - 1))
+            if not breaker.allow():
+                raise IikoUnavailable(f"iiko {endpoint}: предохранитель разомкнут")
+
+            try:
+                response = await self._post_once(endpoint, json, auth)
+            except httpx.TransportError as e:
+                breaker.record_failure()
+                if attempt + 1 == attempts:
+                    raise IikoUnavailable(f"iiko {endpoint}: {e!r}") from e
+                continue
+            except BaseException:
+                # отмена или ошибка не от iiko (например, токен) - о доступности это ничего не говорит
+                breaker.abandon()
+                raise
+
+            if not is_retryable(response.status_code):
+                breaker.record_success()
+                return response
+            breaker.record_failure()
+
+        # повторы кончились на 5xx/429 - отдаём ответ, вызывающий сам решает, что с ним делать
+        return response
+
+    async def _post_once(self, endpoint: str, json: dict, auth: bool) -> httpx.Response:
+        url, timeout = self.endpoints[endpoint]
+        timeout = httpx.Timeout(timeout, connect=min(CONNECT_TIMEOUT, timeout))
+
+        if not auth:
+            return await self._send(endpoint, url, json, None, timeout)
+
+        from iiko_token.update_token import token_manager
+
+        token = await token_manager.get_token()
+        response = await self._send(endpoint, url, json, auth_headers(token), timeout)
+
+        # токен могли отозвать раньше срока - один раз принудительно обновляем и повторяем
+        if response.status_code == 401:
+            token = await token_manager.refresh(token)
+            response = await self._send(endpoint, url, json, auth_headers(token), timeout)
+
+        return response
+
+    async def _send(self, endpoint: str, url: str, json: dict, headers: dict | None, timeout) -> httpx.Response:
+        start = time.perf_counter()
+        status = "error"
+        try:
+            response = await self._client.post(url, json=json, headers=headers, timeout=timeout)
+            status = str(response.status_code)
+            return response
+        finally:
+            IIKO_LATENCY.labels(endpoint).observe(time.perf_counter() - start)
+            IIKO_RESPONSES.labels(endpoint, status).inc()
+
+
+def auth_headers(token: str) -> dict:
+    return {"Authorization": f"Bearer {token}"}
+
+
+iiko_client = IikoClient()
@@ -0,0 +1,124 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+
+from monitoring.metrics import cache_result
+from redis_config import redis_client as redis
+
+# Схема зала меняется редко: в пределах этого окна не ходим в iiko вовсе
+LAYOUT_REFRESH_SECONDS = int(os.getenv("LAYOUT_REFRESH_SECONDS", 10 * 60))
+# Старые версии держим, чтобы уже отправленные кнопки WebApp продолжали открываться
+LAYOUT_VERSION_TTL = int(os.getenv("LAYOUT_VERSION_TTL", 7 * 24 * 60 * 60))
+
+
+def layout_key(terminal_group_id: str) -> str:
+    return f"iiko:layout:{terminal_group_id}"
+
+
+def layout_version_key(version: str) -> str:
+    return f"iiko:layout:version:{version}"
+
+
+def normalize_section(section: dict) -> dict:
+    if section.get("isDeleted", False):
+        return {"id": section["id"], "isDeleted": True}
+
+    elements = {}
+    if section.get("schema"):
+        elements = {el["tableId"]: el for el in section["schema"].get("tableElements", [])}
+
+    tables = []
+    for t in section.get("tables", []):
+        if t.get("isDeleted", False):
+            continue
+        el = elements.get(t["id"], {})
+        tables.append({
+            "id": t["id"],
+            "number": t["number"],
+            "seatingCapacity": t["seatingCapacity"],
+            "name": t.get("name", f"Стол {t['number']}"),
+            "x": el.get("x"),
+            "y": el.get("y"),
+            "width": el.get("width"),
+            "height": el.get("height")
+        })
+
+    return {
+        "id": section["id"],
+        "name": section["name"],
+        "tables": tables
+    }
+
+
+class LayoutCache:
+    def __init__(self, refresh_seconds: int = LAYOUT_REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self._locks: dict[str, asyncio.Lock] = {}
+
+    async def read(self, terminal_group_id: str) -> dict | None:
+        raw = await redis.redis_client.get(layout_key(terminal_group_id))
+        return json.loads(raw) if raw else None
+
+    async def read_version(self, version: str) -> str | None:
+        return await redis.redis_client.get(layout_version_key(version))
+
+    async def get(self, terminal_group_id: str, load) -> dict:
+        cached = await self.read(terminal_group_id)
+        if self._is_fresh(cached):
+            cache_result("layout", "hit")
+            return cached
+
+        cache_result("layout", "miss")
+        lock = self._locks.setdefault(terminal_group_id, asyncio.Lock())
+        async with lock:
+            # пока ждали блокировку, схему мог обновить другой запрос
+            cached = await self.read(terminal_group_id)
+            if self._is_fresh(cached):
+                return cached
+
+            revision = cached["revision"] if cached else 0
+            try:
+                new_revision, changed = await load(terminal_group_id, revision)
+            except Exception:
+                # схема меняется редко - во время сбоя iiko последняя известная лучше ошибки
+                if not (cached and cached.get("version")):
+                    raise
+                cache_result("layout", "fallback")
+                return {**cached, "stale": True}
+
+            sections = cached["sections"] if cached else []
+            sections = merge_sections(sections, changed)
+
+            body = json.dumps(sections, ensure_ascii=False, separators=(",", ":"))
+            record = {
+                "revision": new_revision,
+                "refreshed_at": time.time(),
+                "version": hashlib.sha1(body.encode()).hexdigest()[:12],
+                "sections": sections
+            }
+
+            async with redis.redis_client.pipeline(transaction=False) as pipe:
+                pipe.set(layout_key(terminal_group_id), json.dumps(record, ensure_ascii=False))
+                pipe.set(layout_version_key(record["version"]), body, ex=LAYOUT_VERSION_TTL)
+                await pipe.execute()
+            return record
+
+    def _is_fresh(self, cached: dict | None) -> bool:
+        return bool(cached and cached.get("version")) and time.time() - cached["refreshed_at"] < self.refresh_seconds
+
+
+def merge_sections(sections: list, changed: list) -> list:
+    # iiko отдаёт только секции, изменившиеся после переданной ревизии
+    changed_by_id = {s["id"]: s for s in changed}
+    merged = []
+    for section in sections:
+        section = changed_by_id.pop(section["id"], section)
+        if not section.get("isDeleted"):
+            merged.append(section)
+    merged.extend(s for s in changed_by_id.values() if not s.get("isDeleted"))
+    return merged
+
+
+layout_cache = LayoutCache()
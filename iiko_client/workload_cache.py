@@ -0,0 +1,134 @@
+import asyncio
+import os
+import time
+from datetime import date, timedelta
+
+from monitoring.metrics import cache_result
+from redis_config import redis_client as redis
+
+INVALIDATE_CHANNEL = "workload-invalidate"
+
+# Сколько загрузка дня считается свежей и сколько её ещё можно отдавать, обновляя в фоне
+WORKLOAD_TTL = float(os.getenv("WORKLOAD_CACHE_TTL", 15))
+WORKLOAD_STALE_TTL = float(os.getenv("WORKLOAD_CACHE_STALE_TTL", 120))
+# Дата приходит от клиента: кешируем только дни, на которые можно забронировать,
+# иначе записи копились бы на любые присланные даты
+BOOKING_WINDOW_DAYS = int(os.getenv("BOOKING_WINDOW_DAYS", 60))
+
+
+class StaleWorkload(Exception):
+    # load не достучался до iiko, но нашёл последнюю известную загрузку - её отдаём как устаревшую
+    def __init__(self, reserves: list):
+        super().__init__("загрузка устарела")
+        self.reserves = reserves
+
+
+def booking_window() -> tuple[str, str]:
+    today = date.today()
+    # вчерашний день ещё нужен: бронь, переходящая через полночь, пока идёт
+    return (today - timedelta(days=1)).isoformat(), (today + timedelta(days=BOOKING_WINDOW_DAYS)).isoformat()
+
+
+def booking_day(value: str) -> str:
+    # ValueError - не дата или дата вне окна бронирования
+    day = date.fromisoformat(value).isoformat()
+    first, last = booking_window()
+    if not first <= day <= last:
+        raise ValueError(f"Дата {day} вне окна бронирования")
+    return day
+
+
+class WorkloadCache:
+    def __init__(self, ttl: float = WORKLOAD_TTL, stale_ttl: float = WORKLOAD_STALE_TTL):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+
+        # date -> (время загрузки, reserves)
+        self._entries: dict[str, tuple[float, list]] = {}
+        self._inflight: dict[str, asyncio.Future] = {}
+        # инвалидация поднимает поколение, чтобы запоздавший ответ iiko не перезаписал кеш
+        self._generations: dict[str, int] = {}
+
+    async def get(self, date: str, load) -> tuple[list, bool]:
+        # второе значение - True, если iiko не ответил и отдана последняя известная загрузка
+        entry = self._entries.get(date)
+        if entry:
+            age = time.monotonic() - entry[0]
+            if age < self.ttl:
+                cache_result("workload", "hit")
+                return entry[1], False
+            if age < self.stale_ttl:
+                cache_result("workload", "stale")
+                self._start_load(date, load)
+                return entry[1], False
+
+        cache_result("workload", "miss")
+        try:
+            return await asyncio.shield(self._start_load(date, load)), False
+        except StaleWorkload as e:
+            cache_result("workload", "fallback")
+            return e.reserves, True
+        except Exception:
+            if entry is None:
+                raise
+            cache_result("workload", "fallback")
+            return entry[1], True
+
+    def _start_load(self, date: str, load) -> asyncio.Future:
+        inflight = self._inflight.get(date)
+        if inflight is None or inflight.done():
+            inflight = asyncio.ensure_future(self._load(date, load, self._generations.get(date, 0)))
+            inflight.add_done_callback(_consume_exception)
+            self._inflight[date] = inflight
+        return inflight
+
+    async def _load(self, date: str, load, generation: int) -> list:
+        try:
+            reserves = await load(date)
+        finally:
+            if self._generations.get(date, 0) == generation:
+                self._inflight.pop(date, None)
+
+        if self._generations.get(date, 0) == generation:
+            self._entries[date] = (time.monotonic(), reserves)
+            self._evict()
+        return reserves
+
+    def _evict(self):
+        # прошедшие дни выпадают из окна - их загрузка больше не нужна
+        first, last = booking_window()
+        for entries in (self._entries, self._generations):
+            for day in [day for day in entries if not first <= day <= last]:
+                del entries[day]
+
+    def invalidate_local(self, date: str):
+        self._generations[date] = self._generations.get(date, 0) + 1
+        self._inflight.pop(date, None)
+        # запись не удаляем, а делаем заведомо устаревшей: если iiko упадёт, она пойдёт в fallback
+        entry = self._entries.get(date)
+        if entry:
+            self._entries[date] = (float("-inf"), entry[1])
+        self._evict()
+
+    async def invalidate(self, date: str):
+        from iiko_client.workload_sync import mark_day_dirty
+
+        self.invalidate_local(date)
+        # снимок синхронизации не знает о нашей записи - до следующего прохода читаем iiko
+        await mark_day_dirty(date)
+        await redis.redis_client.publish(INVALIDATE_CHANNEL, date)
+
+    async def listen_invalidations(self):
+        pubsub = redis.redis_client.pubsub()
+        await pubsub.subscribe(INVALIDATE_CHANNEL)
+        async for message in pubsub.listen():
+            if message["type"] == "message":
+                self.invalidate_local(message["data"])
+
+
+def _consume_exception(future: asyncio.Future):
+    if not future.cancelled() and future.exception():
+        print(f"Не удалось обновить загрузку зала: {future.exception()}")
+
+
+workload_cache = WorkloadCache()
@@ -0,0 +1,217 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from datetime import date, datetime, timedelta
+
+from iiko_client.client import iiko_client
+from iiko_client.workload_cache import INVALIDATE_CHANNEL
+from monitoring.metrics import cache_result
+from redis_config import redis_client as redis
+
+# Загрузку зала на ближайшие дни забирает из iiko один фоновый воркер и раскладывает
+# по дням в Redis; запросы WebApp читают только отсюда и в iiko не ходят.
+WORKLOAD_SYNC_DAYS = int(os.getenv("WORKLOAD_SYNC_DAYS", 14))
+WORKLOAD_SYNC_INTERVAL = float(os.getenv("WORKLOAD_SYNC_INTERVAL", 15))
+# Снимок старше этого считаем брошенным (воркер не работает) - читатели идут в iiko сами
+WORKLOAD_MAX_AGE = float(os.getenv("WORKLOAD_MAX_AGE", max(WORKLOAD_SYNC_INTERVAL * 4, 60)))
+WORKLOAD_CHANGES_MAXLEN = int(os.getenv("WORKLOAD_CHANGES_MAXLEN", 10000))
+
+SYNCED_KEY = "workload:synced"
+# date -> время нашей последней записи в iiko; снимки, снятые раньше, для этого дня недействительны
+DIRTY_KEY = "workload:dirty"
+CHANGES_STREAM = "workload:changes"
+LEASE_KEY = "workload:sync:lease"
+# прошедшие дни выпадают из окна и больше не обновляются - пусть истекают сами
+DAY_TTL = 2 * 24 * 60 * 60
+
+# Продлевает аренду, если она наша, или берёт свободную. KEYS[1] - ключ, ARGV[1] - владелец, ARGV[2] - мс
+LEASE_SCRIPT = """
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return 1
+end
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+
+def day_key(day: str) -> str:
+    return f"workload:day:{day}"
+
+
+def dumps(value) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), sort_keys=True)
+
+
+def compact_reserve(reserve: dict) -> dict:
+    # в Redis - только то, что нужно OccupancyIndex
+    return {
+        "id": reserve["id"],
+        "tableIds": reserve.get("tableIds", []),
+        "estimatedStartTime": reserve["estimatedStartTime"],
+        "durationInMinutes": reserve.get("durationInMinutes"),
+    }
+
+
+async def fetch_workload(date_from: str, date_to: str) -> list[dict]:
+    payload = {
+        "restaurantSectionIds": [os.getenv("SECTION_ID")],
+        "dateFrom": f"{date_from}T00:00:00",
+        "dateTo": f"{date_to}T23:59:59"
+    }
+
+    response = await iiko_client.post("workload", payload)
+    response.raise_for_status()
+    return response.json().get("reserves", [])
+
+
+def split_by_day(reserves: list[dict], days: list[str], default_duration: int = 120) -> dict[str, list[dict]]:
+    # бронь, переходящая через полночь, попадает в оба дня - как при запросе по одному дню
+    by_day = {day: [] for day in days}
+    for reserve in reserves:
+        start = datetime.fromisoformat(reserve["estimatedStartTime"])
+        end = start + timedelta(minutes=reserve.get("durationInMinutes") or default_duration)
+        day = start.date()
+        while day <= (end - timedelta(microseconds=1)).date():
+            if day.isoformat() in by_day:
+                by_day[day.isoformat()].append(compact_reserve(reserve))
+            day += timedelta(days=1)
+    return by_day
+
+
+def diff_reserves(previous: dict[str, str], current: dict[str, str]) -> dict[str, list[str]]:
+    return {
+        "added": sorted(current.keys() - previous.keys()),
+        "removed": sorted(previous.keys() - current.keys()),
+        "changed": sorted(rid for rid in current.keys() & previous.keys() if current[rid] != previous[rid]),
+    }
+
+
+async def read_day(day: str, fallback: bool = False) -> list[dict] | None:
+    # None - снимка нет или он устарел, вызывающий сам сходит в iiko.
+    # fallback - iiko недоступен: годится любой сохранённый снимок, как бы стар он ни был
+    async with redis.redis_client.pipeline(transaction=False) as pipe:
+        pipe.get(day_key(day))
+        pipe.hget(SYNCED_KEY, day)
+        pipe.hget(DIRTY_KEY, day)
+        raw, synced_at, dirty_at = await pipe.execute()
+
+    if fallback:
+        cache_result("workload_store", "fallback" if raw is not None else "miss")
+        return json.loads(raw) if raw is not None else None
+    if (
+        raw is None or synced_at is None
+        or time.time() - float(synced_at) > WORKLOAD_MAX_AGE
+        or (dirty_at is not None and float(dirty_at) >= float(synced_at))
+    ):
+        cache_result("workload_store", "miss")
+        return None
+    cache_result("workload_store", "hit")
+    return json.loads(raw)
+
+
+async def mark_day_dirty(day: str):
+    # после своей записи в iiko снимок дня неактуален, пока синхронизация не перечитает день
+    await redis.redis_client.hset(DIRTY_KEY, day, time.time())
+
+
+class WorkloadSync:
+    def __init__(self, days: int = WORKLOAD_SYNC_DAYS, interval: float = WORKLOAD_SYNC_INTERVAL):
+        self.days = days
+        self.interval = interval
+        self.owner = uuid.uuid4().hex
+        # day -> {reserve_id: json брони} с прошлого прохода
+        self._snapshots: dict[str, dict[str, str]] | None = None
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        lease = redis.redis_client.register_script(LEASE_SCRIPT)
+        while True:
+            try:
+                # реплик бота может быть несколько, в iiko ходит только держатель аренды
+                if await lease(keys=[LEASE_KEY], args=[self.owner, int(self.interval * 3 * 1000)]):
+                    await self.sync_once()
+                else:
+                    self._snapshots = None
+            except Exception as e:
+                print(f"Не удалось синхронизировать загрузку зала: {e}")
+            await asyncio.sleep(self.interval)
+
+    def window(self) -> list[str]:
+        today = date.today()
+        return [(today + timedelta(days=i)).isoformat() for i in range(self.days)]
+
+    async def _load_snapshots(self, days: list[str]) -> dict[str, dict[str, str]]:
+        # после рестарта сравниваем с тем, что уже лежит в Redis, а не с пустотой
+        async with redis.redis_client.pipeline(transaction=False) as pipe:
+            for day in days:
+                pipe.get(day_key(day))
+            stored = await pipe.execute()
+        return {
+            day: {r["id"]: dumps(r) for r in json.loads(raw)}
+            for day, raw in zip(days, stored)
+            if raw is not None
+        }
+
+    async def sync_once(self) -> dict[str, dict[str, list[str]]]:
+        days = self.window()
+        # время до запроса: запись в iiko, сделанная во время запроса, оставит день грязным
+        started = time.time()
+        reserves = await fetch_workload(days[0], days[-1])
+        by_day = split_by_day(reserves, days)
+
+        previous = self._snapshots
+        if previous is None:
+            previous = await self._load_snapshots(days)
+
+        snapshots = {}
+        changes = {}
+        async with redis.redis_client.pipeline(transaction=False) as pipe:
+            for day in days:
+                current = {r["id"]: dumps(r) for r in by_day[day]}
+                snapshots[day] = current
+                diff = diff_reserves(previous.get(day, {}), current)
+                if day not in previous or any(diff.values()):
+                    body = "[" + ",".join(current[rid] for rid in sorted(current)) + "]"
+                    pipe.set(day_key(day), body, ex=DAY_TTL)
+                else:
+                    pipe.expire(day_key(day), DAY_TTL)
+                if any(diff.values()):
+                    changes[day] = diff
+                    pipe.xadd(
+                        CHANGES_STREAM,
+                        {"date": day, "at": started, **{kind: json.dumps(ids) for kind, ids in diff.items()}},
+                        maxlen=WORKLOAD_CHANGES_MAXLEN,
+                        approximate=True
+                    )
+                    # локальные кеши API сбрасываем сразу, не дожидаясь их TTL
+                    pipe.publish(INVALIDATE_CHANNEL, day)
+            pipe.hset(SYNCED_KEY, mapping={day: started for day in days})
+            for key in (SYNCED_KEY, DIRTY_KEY):
+                past = [day for day in await redis.redis_client.hkeys(key) if day < days[0]]
+                if past:
+                    pipe.hdel(key, *past)
+            await pipe.execute()
+
+        self._snapshots = snapshots
+        return changes
+
+
+workload_sync = WorkloadSync()
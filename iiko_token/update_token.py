@@ -1,23 +1,152 @@
-import requests
-from dotenv import load_dotenv
+import asyncio
+import json
 import os
+import time
+import uuid
+
+from dotenv import load_dotenv
+
+from redis_config import redis_client as redis
+from redis_config.redis_helpers import release_lock
 
 load_dotenv()
 
-def update_iiko_token(key:str):
-    headers = {
-        "Content-Type": "application/json"
-    }
+TOKEN_KEY = "iiko:token"
+TOKEN_LOCK_KEY = "iiko:token:lock"
+
+# iiko выдаёт токен на час, обновляем заранее, чтобы не ловить 401 на границе
+TOKEN_TTL = int(os.getenv("IIKO_TOKEN_TTL", 60 * 60))
+TOKEN_REFRESH_MARGIN = int(os.getenv("IIKO_TOKEN_REFRESH_MARGIN", 5 * 60))
+TOKEN_SHARED = os.getenv("IIKO_TOKEN_SHARED", "1") == "1"
+
+
+async def update_iiko_token(key: str) -> str:
+    from iiko_client.client import iiko_client
+
+    response = await iiko_client.post("token", {"apiLogin": key}, auth=False)
+    response.raise_for_status()
+    return response.json()["token"]
+
+
+class TokenManager:
+    def __init__(self, api_key: str, ttl: int = TOKEN_TTL, margin: int = TOKEN_REFRESH_MARGIN, shared: bool = TOKEN_SHARED):
+        self.api_key = api_key
+        self.ttl = ttl
+        self.margin = margin
+        self.shared = shared
+
+        self._token: str | None = None
+        self._expires_at = 0.0
+        self._inflight: asyncio.Future | None = None
+        self._keeper: asyncio.Task | None = None
+
+    async def get_token(self) -> str:
+        now = time.time()
+        if self._token and now < self._expires_at:
+            # токен ещё жив, но скоро истечёт - обновляем в фоне, не задерживая вызов
+            if now >= self._expires_at - self.margin:
+                self._refresh_in_background()
+            return self._token
+
+        return await self._single_flight(rejected=None)
+
+    async def refresh(self, rejected: str | None = None) -> str:
+        # Вызывается после 401. Если кто-то уже успел обновить токен - просто отдаём новый
+        if rejected is not None and self._token and self._token != rejected and time.time() < self._expires_at:
+            return self._token
+
+        return await self._single_flight(rejected=rejected or self._token)
 
-    json = {
-        "apiLogin": key
-    }
+    def start(self):
+        if self._keeper is None or self._keeper.done():
+            self._keeper = asyncio.create_task(self._keep_fresh())
 
-    response = requests.post(os.getenv("IIKO_TOKEN_URL"), json=json, headers=headers)
-    if response.status_code == 200:
-        response.raise_for_status()
-        data = response.json()
-        token = data['token']
+    async def close(self):
+        if self._keeper is not None:
+            self._keeper.cancel()
+            try:
+                await self._keeper
+            except asyncio.CancelledError:
+                pass
+            self._keeper = None
+
+    async def _keep_fresh(self):
+        while True:
+            try:
+                if not self._token or time.time() >= self._expires_at - self.margin:
+                    await self._single_flight(rejected=None)
+                delay = max(self._expires_at - self.margin - time.time(), 1)
+            except Exception as e:
+                print(f"Не удалось обновить токен iiko: {e}")
+                delay = 10
+            await asyncio.sleep(delay)
+
+    def _refresh_in_background(self):
+        if self._inflight is None or self._inflight.done():
+            self._inflight = asyncio.ensure_future(self._load(rejected=None))
+            self._inflight.add_done_callback(_consume_exception)
+
+    async def _single_flight(self, rejected: str | None) -> str:
+        if self._inflight is None or self._inflight.done():
+            self._inflight = asyncio.ensure_future(self._load(rejected))
+        # shield: отмена одного ожидающего не должна ронять общий запрос
+        return await asyncio.shield(self._inflight)
+
+    async def _load(self, rejected: str | None) -> str:
+        if self.shared:
+            token, expires_at = await self._load_shared(rejected)
+        else:
+            token = await update_iiko_token(self.api_key)
+            expires_at = time.time() + self.ttl
+
+        self._token = token
+        self._expires_at = expires_at
         return token
-    else:
-        return(response.status_code, response.text)
+
+    async def _read_shared(self, rejected: str | None):
+        raw = await redis.redis_client.get(TOKEN_KEY)
+        if not raw:
+            return None
+
+        cached = json.loads(raw)
+        if cached["token"] == rejected or time.time() >= cached["expires_at"] - self.margin:
+            return None
+        return cached["token"], cached["expires_at"]
+
+    async def _load_shared(self, rejected: str | None):
+        cached = await self._read_shared(rejected)
+        if cached:
+            return cached
+
+        # Логинится только один процесс (api или bot), остальные ждут его результат.
+        # Снимаем только свою блокировку: если логин шёл дольше её TTL, её уже взял другой
+        lock_token = uuid.uuid4().hex
+        if await redis.redis_client.set(TOKEN_LOCK_KEY, lock_token, nx=True, ex=30):
+            try:
+                token = await update_iiko_token(self.api_key)
+                expires_at = time.time() + self.ttl
+                await redis.redis_client.set(
+                    TOKEN_KEY,
+                    json.dumps({"token": token, "expires_at": expires_at}),
+                    ex=self.ttl
+                )
+                return token, expires_at
+            finally:
+                await release_lock(TOKEN_LOCK_KEY, lock_token)
+
+        for _ in range(50):
+            await asyncio.sleep(0.1)
+            cached = await self._read_shared(rejected)
+            if cached:
+                return cached
+
+        token = await update_iiko_token(self.api_key)
+        return token, time.time() + self.ttl
+
+
+def _consume_exception(future: asyncio.Future):
+    if not future.cancelled() and future.exception():
+        print(f"Не удалось обновить токен iiko: {future.exception()}")
+
+
+token_manager = TokenManager(os.getenv("IIKO_KEY"))
@@ -1,48 +1,84 @@
-from telegram.ext import CommandHandler, MessageHandler, ApplicationBuilder, filters, CallbackQueryHandler
-from bot.comands import ReservationBot
+from telegram import Update
+from bot.application import build_application, check_webhook_config, BOT_MODE, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_MAX_CONNECTIONS
 from dotenv import load_dotenv
 from redis_config import redis_helpers
-from bot.reminder_mes import scheduler
-import os
+from bot.reminder_mes import reminder_engine
+from bot.reservation_jobs import reservation_jobs
+from iiko_token.update_token import token_manager
+from iiko_client.client import iiko_client
+from iiko_client.workload_sync import workload_sync
+from monitoring.metrics import start_metrics_server
+import signal
 import asyncio
 
 load_dotenv()
 
-TOKEN = os.getenv("TOKEN")
-
 
 
 def main():
+    if BOT_MODE == "webhook":
+        check_webhook_config()
+
     bot = None
-    
+    background_tasks = []
+
+    # Фоновые задачи живут только в этом процессе - и при polling, и при webhook
     async def post_init(app):
-        nonlocal bot
-        bot = ReservationBot(app)
-        scheduler.start()
-        asyncio.create_task(
-            redis_helpers.listen_new_reservations(
+        await redis_helpers.migrate_reservation_records()
+        await redis_helpers.rebuild_reservation_indexes()
+        start_metrics_server()
+        await iiko_client.start()
+        token_manager.start()
+        reminder_engine.start(app)
+        reservation_jobs.start(app)
+        workload_sync.start()
+        background_tasks.append(asyncio.create_task(
+            redis_helpers.consume_reservation_events(
                 bot.new_reservation_notification
             )
-        )
-
-    app = (
-        ApplicationBuilder()
-        .token(TOKEN)
-        .post_init(post_init)
-        .build()
-    )
+        ))
+        if BOT_MODE != "webhook":
+            background_tasks.append(asyncio.create_task(redis_helpers.listen_user_data_invalidations()))
 
-    bot = ReservationBot(app)
+    async def post_shutdown(app):
+        for task in background_tasks:
+            task.cancel()
+        await reminder_engine.stop()
+        await reservation_jobs.stop()
+        await workload_sync.stop()
+        await token_manager.close()
+        await iiko_client.close()
 
-    app.add_handler(CommandHandler("start", bot.start))
-    app.add_handler(CallbackQueryHandler(bot.callback))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.CONTACT, bot.text_handler))
-    app.add_handler(MessageHandler(filters.CONTACT, bot.number_handler))
-    app.add_handler(MessageHandler(filters.StatusUpdate.WEB_APP_DATA, bot.web_app_handler))
+    app, bot = build_application(post_init, post_shutdown, updater=BOT_MODE != "webhook")
 
     print("Бот запущен")
-    app.run_polling()
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook_background(app, post_init, post_shutdown))
+    else:
+        app.run_polling()
+
+async def run_webhook_background(app, post_init, post_shutdown):
+    # Обновления принимают воркеры api_main, здесь только вебхук и фоновые задачи
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await app.initialize()
+    try:
+        await post_init(app)
+        await app.bot.set_webhook(
+            url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES
+        )
+        await app.start()
+        await stop.wait()
+        await app.stop()
+    finally:
+        await post_shutdown(app)
+        await app.shutdown()
 
 if __name__ == "__main__":
     main()
-
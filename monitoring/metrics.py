@@ -0,0 +1,130 @@
+import functools
+import os
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest,
+    start_http_server
+)
+from prometheus_client import multiprocess
+
+# Порт /metrics процесса бота (main.py); 0 - не поднимать
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9101))
+
+# Бакеты под наши масштабы: Redis - доли миллисекунды, iiko и Telegram - до десятков секунд
+FAST_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5)
+SLOW_BUCKETS = (.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 20, 30)
+
+HANDLER_LATENCY = Histogram(
+    "bot_handler_seconds", "Время обработки обновления по обработчикам",
+    ["handler"], buckets=SLOW_BUCKETS
+)
+CALLBACK_LATENCY = Histogram(
+    "bot_callback_seconds", "Время обработки нажатия кнопки по действиям",
+    ["action"], buckets=SLOW_BUCKETS
+)
+HANDLER_ERRORS = Counter(
+    "bot_handler_errors_total", "Исключения в обработчиках", ["handler"]
+)
+
+IIKO_LATENCY = Histogram(
+    "iiko_request_seconds", "Время запросов к iiko", ["endpoint"], buckets=SLOW_BUCKETS
+)
+IIKO_RESPONSES = Counter(
+    "iiko_responses_total", "Ответы iiko по статусам; error - до ответа не дошло",
+    ["endpoint", "status"]
+)
+IIKO_RETRIES = Counter(
+    "iiko_retries_total", "Повторы запросов к iiko", ["endpoint"]
+)
+IIKO_BREAKER_OPEN = Gauge(
+    "iiko_breaker_open", "1 - предохранитель эндпоинта iiko разомкнут, запросы не идут",
+    ["endpoint"], multiprocess_mode="max"
+)
+
+RESERVATION_JOBS = Counter(
+    "reservation_jobs_total", "Задания записи в iiko: done, retry, failed", ["kind", "result"]
+)
+
+REDIS_LATENCY = Histogram(
+    "redis_command_seconds", "Время команд Redis; пайплайн считается одной командой",
+    ["command"], buckets=FAST_BUCKETS
+)
+
+SCHEDULER_LAG = Histogram(
+    "reminder_lag_seconds", "Насколько позже назначенного сработало напоминание",
+    ["kind"], buckets=SLOW_BUCKETS
+)
+
+CACHE_REQUESTS = Counter(
+    "cache_requests_total",
+    "Обращения к кешам: hit, stale (отдали старое и обновляем), miss, fallback (iiko недоступен)",
+    ["cache", "result"]
+)
+
+TELEGRAM_QUEUE_DEPTH = Gauge(
+    "telegram_send_queue_depth", "Запросы к Telegram, ждущие лимитера", multiprocess_mode="livesum"
+)
+
+TELEGRAM_SEND_WAIT = Histogram(
+    "telegram_send_wait_seconds", "Сколько запрос к Telegram ждал в очереди лимитера",
+    ["priority"], buckets=SLOW_BUCKETS
+)
+
+TELEGRAM_RETRY_AFTER = Counter(
+    "telegram_retry_after_total", "Ответы Telegram 429 (RetryAfter)"
+)
+
+
+# Действия кнопок бота. callback_data присылает клиент и может подделать её - в метку
+# попадают только известные имена, иначе число рядов метрики ничем не ограничено
+CALLBACK_ACTIONS = frozenset({
+    "approve", "back_to_start", "cancel", "confirm_cancel", "confirm_no", "confirm_yes",
+    "continue", "create_reservation", "deny_cancel", "detail_reservation", "edit_name",
+    "edit_phone", "edit_table", "me", "my_reservations", "noop", "other_people", "page",
+    "reject", "reservation", "view_reservations",
+})
+
+
+def callback_action(data: str | None) -> str:
+    # id в callback_data не нужны в метках - только имя действия
+    if not data:
+        return "unknown"
+    action = data.split(":", 1)[0]
+    return action if action in CALLBACK_ACTIONS else "other"
+
+
+def timed_handler(name: str, handler):
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        start = time.perf_counter()
+        try:
+            return await handler(update, context)
+        except Exception:
+            HANDLER_ERRORS.labels(name).inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            HANDLER_LATENCY.labels(name).observe(elapsed)
+            if name == "callback" and update.callback_query:
+                CALLBACK_LATENCY.labels(callback_action(update.callback_query.data)).observe(elapsed)
+    return wrapper
+
+
+def cache_result(cache: str, result: str):
+    CACHE_REQUESTS.labels(cache, result).inc()
+
+
+def render_metrics() -> tuple[bytes, str]:
+    # несколько воркеров uvicorn пишут метрики в PROMETHEUS_MULTIPROC_DIR, собираем их вместе
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def start_metrics_server(port: int = METRICS_PORT):
+    if port:
+        start_http_server(port)
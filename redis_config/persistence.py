@@ -0,0 +1,209 @@
+import asyncio
+import json
+import os
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from redis_config import redis_client as redis
+from redis_config.redis_helpers import script
+
+# Как часто PTB отдаёт изменённый user_data (секунды).
+# Все изменения за интервал уходят в Redis одним пайплайном
+PERSISTENCE_FLUSH_INTERVAL = float(os.getenv("PERSISTENCE_FLUSH_INTERVAL", 10))
+
+USER_DATA_KEY = "bot:user_data"
+
+# KEYS[1] - хеш данных, KEYS[2] - хеш версий; ARGV - тройки: поле, версия, которую мы видели,
+# JSON ('' - удалить). Поле пишется, только если с нашего чтения его никто не менял.
+# Возвращает новые версии по порядку, -1 - поле изменила другая реплика
+WRITE_SCRIPT = """
+local result = {}
+for i = 1, #ARGV, 3 do
+    local current = tonumber(redis.call('HGET', KEYS[2], ARGV[i]) or '0')
+    if current ~= tonumber(ARGV[i + 1]) then
+        result[#result + 1] = -1
+    else
+        if ARGV[i + 2] == '' then
+            redis.call('HDEL', KEYS[1], ARGV[i])
+        else
+            redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 2])
+        end
+        result[#result + 1] = redis.call('HINCRBY', KEYS[2], ARGV[i], 1)
+    end
+end
+return result
+"""
+
+
+def dumps(value) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+def version_key(key: str) -> str:
+    return f"{key}:version"
+
+
+class RedisPersistence(BasePersistence):
+    # user_data в хеше Redis в компактном JSON; chat_data и bot_data бот не использует - не храним.
+    # update_* только копят изменения, запись - один пайплайн на цикл update_persistence.
+    # В webhook-режиме реплик несколько: у каждого поля есть версия, refresh_user_data перед
+    # обновлением подтягивает поле, если его записал кто-то другой, а запись не перетирает поле,
+    # изменённое с нашего чтения. В polling процесс один - состояние его, refresh не ходит в Redis.
+    # Ключи словарей после загрузки становятся строками (JSON), значения - только JSON-типы
+
+    def __init__(self, update_interval: float = PERSISTENCE_FLUSH_INTERVAL, distributed: bool = False):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+            update_interval=update_interval
+        )
+        self.distributed = distributed
+        # (hash key, field) -> json или None (удалить поле)
+        self._pending: dict[tuple[str, str], str | None] = {}
+        # последнее записанное значение - неизменённые поля повторно не пишем
+        self._written: dict[tuple[str, str], str] = {}
+        # версия поля, которую мы видели последней; 0 - поля не было
+        self._versions: dict[tuple[str, str], int] = {}
+        self._flush_task: asyncio.Task | None = None
+
+    async def _load(self, key: str) -> dict[str, object]:
+        async with redis.redis_client.pipeline(transaction=True) as pipe:
+            pipe.hgetall(key)
+            pipe.hgetall(version_key(key))
+            stored, versions = await pipe.execute()
+        for field, version in versions.items():
+            self._versions[(key, field)] = int(version)
+        for field, value in stored.items():
+            self._written[(key, field)] = value
+        return {field: json.loads(value) for field, value in stored.items()}
+
+    def _accept(self, key: str, field: str, value: str | None, version: int):
+        # чужая запись побеждает: наши незаписанные изменения этого поля отбрасываем
+        self._pending.pop((key, field), None)
+        self._versions[(key, field)] = version
+        if value is None:
+            self._written.pop((key, field), None)
+        else:
+            self._written[(key, field)] = value
+
+    async def get_user_data(self) -> dict[int, dict]:
+        return {int(user_id): data for user_id, data in (await self._load(USER_DATA_KEY)).items()}
+
+    async def get_chat_data(self) -> dict[int, dict]:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state):
+        pass
+
+    def _stage(self, key: str, field, data):
+        field = str(field)
+        # пустой словарь хранить незачем
+        value = dumps(data) if data else None
+        if self._written.get((key, field)) == value:
+            self._pending.pop((key, field), None)
+            return
+        self._pending[(key, field)] = value
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        # PTB вызывает update_* пачкой через gather; задача записи встаёт в очередь
+        # цикла после них и забирает все изменения этого прохода сразу
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._write_pending())
+
+    async def update_user_data(self, user_id: int, data: dict):
+        self._stage(USER_DATA_KEY, user_id, data)
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        pass
+
+    async def update_bot_data(self, data: dict):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_user_data(self, user_id: int):
+        self._stage(USER_DATA_KEY, user_id, None)
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    async def _refresh(self, key: str, field, data: dict):
+        field = str(field)
+        # обычно поле с нашего чтения никто не менял - сверяем только версию, значение не тянем
+        version = int(await redis.redis_client.hget(version_key(key), field) or 0)
+        if version == self._versions.get((key, field), 0):
+            return
+
+        async with redis.redis_client.pipeline(transaction=True) as pipe:
+            pipe.hget(key, field)
+            pipe.hget(version_key(key), field)
+            value, version = await pipe.execute()
+        self._accept(key, field, value, int(version or 0))
+        data.clear()
+        if value is not None:
+            data.update(json.loads(value))
+
+    # PTB вызывает refresh_user_data перед каждым обновлением - берём то, что записали другие реплики
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        if self.distributed:
+            await self._refresh(USER_DATA_KEY, user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict):
+        pass
+
+    async def _write_pending(self):
+        await asyncio.sleep(0)
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, {}
+        by_key: dict[str, list[tuple[str, str | None]]] = {}
+        for (key, field), value in pending.items():
+            by_key.setdefault(key, []).append((field, value))
+
+        write = script(WRITE_SCRIPT)
+        async with redis.redis_client.pipeline(transaction=False) as pipe:
+            for key, items in by_key.items():
+                args = []
+                for field, value in items:
+                    args += [field, self._versions.get((key, field), 0), "" if value is None else value]
+                await write(keys=[key, version_key(key)], args=args, client=pipe)
+            try:
+                results = await pipe.execute()
+            except Exception as e:
+                # вернём в очередь то, что не перезаписали с тех пор, - уйдёт следующим циклом
+                for item, value in pending.items():
+                    self._pending.setdefault(item, value)
+                print(f"Не удалось сохранить данные бота в Redis: {e}")
+                return
+
+        for (key, items), versions in zip(by_key.items(), results):
+            for (field, value), version in zip(items, versions):
+                if version == -1:
+                    # поле изменила другая реплика - забываем свою версию, refresh_* перечитает его
+                    self._versions.pop((key, field), None)
+                    self._written.pop((key, field), None)
+                    continue
+                self._versions[(key, field)] = version
+                if value is None:
+                    self._written.pop((key, field), None)
+                else:
+                    self._written[(key, field)] = value
+
+    async def flush(self):
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._write_pending()
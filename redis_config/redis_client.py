@@ -1,13 +1,40 @@
 import redis.asyncio as redis
+from redis.asyncio.client import Pipeline
 import os
+import time
 from dotenv import load_dotenv
+from monitoring.metrics import REDIS_LATENCY
 load_dotenv()
 
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+REDIS_DB = int(os.getenv("REDIS_DB", 0))
 
-redis_client = redis.Redis(
+class InstrumentedPipeline(Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        start = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            REDIS_LATENCY.labels("MULTI" if self.is_transaction else "PIPELINE").observe(time.perf_counter() - start)
+
+
+class InstrumentedRedis(redis.Redis):
+    # замеряем каждую команду; Lua-скрипты видны как EVALSHA
+    async def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            REDIS_LATENCY.labels(str(args[0]).upper()).observe(time.perf_counter() - start)
+
+    def pipeline(self, transaction: bool = True, shard_hint: str | None = None) -> Pipeline:
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+redis_client = InstrumentedRedis(
     host=REDIS_HOST,
     port=REDIS_PORT,
+    db=REDIS_DB,
     decode_responses=True
 )   
\ No newline at end of file
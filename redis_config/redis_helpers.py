@@ -1,39 +1,327 @@
+import asyncio
 import json
+import os
+import socket
+import time
 import uuid
+from datetime import datetime
+from redis.exceptions import ResponseError
 from redis_config import redis_client as redis
+from redis_config.user_cache import user_state_cache
 
-CHANNEL = "new-reservations"
+# События жизненного цикла заявок: created, approved, rejected, cancelled, confirmation
+EVENTS_STREAM = "reservation:events"
+EVENTS_GROUP = os.getenv("RESERVATION_EVENTS_GROUP", "bot")
+EVENTS_MAXLEN = int(os.getenv("RESERVATION_EVENTS_MAXLEN", 10000))
+EVENTS_BATCH = int(os.getenv("RESERVATION_EVENTS_BATCH", 50))
+EVENTS_BLOCK_MS = int(os.getenv("RESERVATION_EVENTS_BLOCK_MS", 5000))
+# сообщение, которое консьюмер не подтвердил за это время, забирает другой процесс
+EVENTS_RECLAIM_IDLE_MS = int(os.getenv("RESERVATION_EVENTS_RECLAIM_IDLE_MS", 60 * 1000))
+EVENTS_MAX_DELIVERIES = int(os.getenv("RESERVATION_EVENTS_MAX_DELIVERIES", 5))
+# Старый список всех заявок, читается только при миграции в индексы
 REQUESTS_LIST = "reservation:requests"
 
-async def listen_new_reservations(callback):
-    pubsub = redis.redis_client.pubsub()
-    await pubsub.subscribe(CHANNEL)
-    async for message in pubsub.listen():
-        if message["type"] == "message":
-            data = message["data"]
-            await callback(data)
+# индексы прежних версий, которые пересборка удаляет
+LEGACY_DATETIME_INDEX = "reservation:index:datetime"
+LEGACY_USER_INDEX_PATTERN = "reservation:index:user:*"
+INDEX_VERSION_KEY = "reservation:index:version"
+INDEX_VERSION = "3"
+STORAGE_VERSION_KEY = "reservation:storage:version"
+STORAGE_VERSION = "hash"
 
+# Заявка хранится hash'ем, каждое поле - JSON-значение, чтобы не терять типы (int, None).
+# Переходы статусов делаются Lua-скриптами: проверка, запись полей и перенос между
+# индексами выполняются атомарно за один запрос.
+
+# Все ключи, которые трогает скрипт, передаются в KEYS (иначе Redis Cluster и проверки
+# скриптов не видят их). Индекс статуса зависит от текущего статуса, поэтому вызывающий
+# читает его заранее, а скрипт проверяет, что статус с тех пор не изменился.
+
+# KEYS[1] - заявка, KEYS[2] - индекс текущего статуса, KEYS[3] - индекс нового статуса,
+# KEYS[4] - индекс пользователя с текущим статусом, KEYS[5] - индекс пользователя с новым статусом
+# ARGV[1] - id, ARGV[2] - текущий статус в JSON, ARGV[3] - новый статус в JSON,
+# ARGV[4..] - дополнительные поля: имя, значение в JSON
+TRANSITION_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], 'status')
+if not current then return 0 end
+if current ~= ARGV[2] then return -1 end
+
+redis.call('HSET', KEYS[1], 'status', ARGV[3])
+for i = 4, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+
+local created_at = tonumber(redis.call('HGET', KEYS[1], 'created_at')) or 0
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('ZADD', KEYS[3], created_at, ARGV[1])
+
+local starts_at = redis.call('ZSCORE', KEYS[4], ARGV[1])
+redis.call('ZREM', KEYS[4], ARGV[1])
+if starts_at then
+    redis.call('ZADD', KEYS[5], starts_at, ARGV[1])
+end
+return 1
+"""
+
+# KEYS[1] - заявка; ARGV[1] - поле, ARGV[2] - ожидаемое значение в JSON ('' - любое),
+# ARGV[3..] - поля для записи: имя, значение в JSON
+COMPARE_AND_SET_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return 0 end
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+if ARGV[2] ~= '' and current ~= ARGV[2] then return -1 end
+for i = 3, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+return 1
+"""
+
+# KEYS[1] - заявка, KEYS[2] - индекс текущего статуса, KEYS[3] - индекс пользователя
+# с текущим статусом; ARGV[1] - id, ARGV[2] - текущий статус в JSON
+DELETE_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], 'status')
+if not current then return 0 end
+if current ~= ARGV[2] then return -1 end
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('ZREM', KEYS[3], ARGV[1])
+return redis.call('DEL', KEYS[1])
+"""
+
+# KEYS[1] - заявка в старом формате (JSON-строка) -> hash
+MIGRATE_SCRIPT = """
+if redis.call('TYPE', KEYS[1]).ok ~= 'string' then return 0 end
+local reservation = cjson.decode(redis.call('GET', KEYS[1]))
+redis.call('DEL', KEYS[1])
+for field, value in pairs(reservation) do
+    redis.call('HSET', KEYS[1], field, cjson.encode(value))
+end
+return 1
+"""
+
+# KEYS[1] - блокировка; ARGV[1] - токен владельца. Снимает только свою блокировку:
+# чужую, взятую после истечения нашей, не трогаем
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# KEYS[1] - блокировка; ARGV[1] - токен владельца, ARGV[2] - новый TTL в мс.
+# Продлевает только свою блокировку; 0 - она уже истекла или чужая
+RENEW_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+_scripts = {}
+
+def script(source: str):
+    if source not in _scripts:
+        _scripts[source] = redis.redis_client.register_script(source)
+    return _scripts[source]
+
+async def acquire_lock(key: str, ttl_ms: int, timeout: float, poll: float, max_poll: float = 0.5) -> str | None:
+    # ждёт, пока блокировка освободится, опрашивая всё реже; возвращает токен для release_lock,
+    # None - не дождались за timeout
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + timeout
+    while not await redis.redis_client.set(key, token, nx=True, px=ttl_ms):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        await asyncio.sleep(min(poll, remaining))
+        poll = min(poll * 2, max_poll)
+    return token
+
+async def renew_lock(key: str, token: str, ttl_ms: int) -> bool:
+    return await script(RENEW_LOCK_SCRIPT)(keys=[key], args=[token, ttl_ms]) == 1
+
+async def release_lock(key: str, token: str):
+    await script(RELEASE_LOCK_SCRIPT)(keys=[key], args=[token])
+
+def add_event(pipe, event: str, res_id: str, data: dict | None = None):
+    pipe.xadd(
+        EVENTS_STREAM,
+        {"type": event, "id": res_id, "data": json.dumps(data or {})},
+        maxlen=EVENTS_MAXLEN,
+        approximate=True
+    )
+
+async def publish_reservation_event(event: str, res_id: str, data: dict | None = None):
+    async with redis.redis_client.pipeline(transaction=False) as pipe:
+        add_event(pipe, event, res_id, data)
+        await pipe.execute()
+
+def decode_event(entry_id: str, fields: dict) -> dict:
+    return {
+        "entry_id": entry_id,
+        "type": fields["type"],
+        "id": fields["id"],
+        "data": json.loads(fields.get("data") or "{}")
+    }
+
+async def consume_reservation_events(callback, group: str = EVENTS_GROUP, consumer: str | None = None):
+    consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+    client = redis.redis_client
+
+    try:
+        await client.xgroup_create(EVENTS_STREAM, group, id="$", mkstream=True)
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+    async def handle(entries):
+        done = []
+        for entry_id, fields in entries:
+            if fields is None:
+                # запись уже вытеснена MAXLEN - обрабатывать нечего, просто подтверждаем
+                done.append(entry_id)
+                continue
+            try:
+                await callback(decode_event(entry_id, fields))
+                done.append(entry_id)
+            except Exception as e:
+                print(f"Не удалось обработать событие {entry_id}: {e}")
+        if done:
+            await client.xack(EVENTS_STREAM, group, *done)
+
+    last_reclaim = 0.0
+    while True:
+        try:
+            if time.monotonic() - last_reclaim > EVENTS_RECLAIM_IDLE_MS / 1000:
+                last_reclaim = time.monotonic()
+                await reclaim_reservation_events(group, consumer, handle)
+
+            response = await client.xreadgroup(
+                group, consumer, {EVENTS_STREAM: ">"},
+                count=EVENTS_BATCH, block=EVENTS_BLOCK_MS
+            )
+            for _, entries in response:
+                await handle(entries)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Ошибка чтения событий заявок: {e}")
+            await asyncio.sleep(1)
+
+async def reclaim_reservation_events(group: str, consumer: str, handle):
+    client = redis.redis_client
+    start = "0-0"
+    while True:
+        next_start, entries, *_ = await client.xautoclaim(
+            EVENTS_STREAM, group, consumer,
+            min_idle_time=EVENTS_RECLAIM_IDLE_MS, start_id=start, count=EVENTS_BATCH
+        )
+        if entries:
+            # события, которые раз за разом роняют обработчик, снимаем, чтобы не крутились вечно
+            pending = await client.xpending_range(
+                EVENTS_STREAM, group, min=entries[0][0], max=entries[-1][0], count=len(entries)
+            )
+            poisoned = {p["message_id"] for p in pending if p["times_delivered"] > EVENTS_MAX_DELIVERIES}
+            if poisoned:
+                print(f"События отброшены после {EVENTS_MAX_DELIVERIES} попыток: {poisoned}")
+                await client.xack(EVENTS_STREAM, group, *poisoned)
+            await handle([e for e in entries if e[0] not in poisoned])
+
+        if next_start == "0-0" or not entries:
+            return
+        start = next_start
+
+
+USER_DATA_TTL = 60 * 30
+# только ключи анкет reservation:{user_id}, без reservation:request:* и индексов
+USER_DATA_PATTERN = "reservation:[0-9]*"
 
 def redis_key(user_id:int) -> str:
     return f"reservation:{user_id}"
 
 async def get_user_data(user_id:int) -> dict:
-    data = await redis.redis_client.get(redis_key(user_id))
-    return json.loads(data) if data else {}
+    key = redis_key(user_id)
+    cached = user_state_cache.get(key)
+    if cached is not None:
+        return cached
+
+    async with redis.redis_client.pipeline(transaction=False) as pipe:
+        pipe.get(key)
+        pipe.ttl(key)
+        data, ttl = await pipe.execute()
+
+    if not data:
+        return {}
+    data = json.loads(data)
+    # локальная запись живёт не дольше ключа в Redis
+    user_state_cache.put(key, data, ttl if ttl > 0 else USER_DATA_TTL)
+    return data
 
 async def set_user_data(user_id:int, data:dict):
-    await redis.redis_client.set(
-        redis_key(user_id),
-        json.dumps(data),
-        ex=60 * 30
-        )
+    key = redis_key(user_id)
+    user_state_cache.mark_own_write(key)
+    try:
+        await redis.redis_client.set(
+            key,
+            json.dumps(data),
+            ex=USER_DATA_TTL
+            )
+    except Exception:
+        # записи могло не быть - снимаем отметку, иначе она проглотит уведомление о чужой записи.
+        # Если запись всё же прошла, её уведомление просто сбросит кеш
+        user_state_cache.unmark_own_write(key)
+        user_state_cache.invalidate(key)
+        raise
+    user_state_cache.put(key, data, USER_DATA_TTL)
 
 async def clear_user_data(user_id:int):
-    await redis.redis_client.delete(redis_key(user_id))
+    key = redis_key(user_id)
+    user_state_cache.invalidate(key)
+    user_state_cache.mark_own_write(key)
+    try:
+        deleted = await redis.redis_client.delete(key)
+    except Exception:
+        user_state_cache.unmark_own_write(key)
+        raise
+    if not deleted:
+        # ключа не было - уведомления не придёт, снимаем отметку о своей записи
+        user_state_cache.unmark_own_write(key)
+
+async def listen_user_data_invalidations():
+    await user_state_cache.listen_invalidations(USER_DATA_PATTERN)
 
 def reservation_key(res_id: str) -> str:
     return f"reservation:request:{res_id}"
 
+# Индексы - sorted set'ы с id заявок:
+#   по статусу - score = время создания заявки (порядок очереди для админа)
+#   по пользователю и статусу - score = дата и время брони («Мои брони» читают только нужный статус)
+def status_index_key(status: str) -> str:
+    return f"reservation:index:status:{status}"
+
+def user_index_key(user_id: int, status: str) -> str:
+    return f"reservation:index:user_status:{user_id}:{status}"
+
+def reservation_timestamp(reservation: dict) -> float:
+    return datetime.fromisoformat(f"{reservation['date']}T{reservation['time']}").timestamp()
+
+def add_to_indexes(pipe, reservation: dict):
+    res_id = reservation["id"]
+    pipe.zadd(status_index_key(reservation["status"]), {res_id: reservation.get("created_at", 0)})
+    pipe.zadd(user_index_key(reservation["user_id"], reservation["status"]), {res_id: reservation_timestamp(reservation)})
+
+def encode_reservation(reservation: dict) -> dict:
+    return {field: json.dumps(value) for field, value in reservation.items()}
+
+def decode_reservation(fields: dict) -> dict | None:
+    if not fields:
+        return None
+    return {field: json.loads(value) for field, value in fields.items()}
+
+def encode_fields(fields: dict) -> list:
+    args = []
+    for field, value in fields.items():
+        args.extend([field, json.dumps(value)])
+    return args
+
 async def save_reservation(data:dict)->str:
     res_id = str(uuid.uuid4())
 
@@ -49,64 +337,166 @@ async def save_reservation(data:dict)->str:
         "time": data["time"],
         "status": "PENDING",
         "confirmation_status": "WAITING",  
-        "confirmation_message_id": None
+        "confirmation_message_id": None,
+        "created_at": time.time()
     }
-    
-    await redis.redis_client.set(reservation_key(res_id), json.dumps(reserv))
 
-    await redis.redis_client.rpush(REQUESTS_LIST, res_id)
-
-    await redis.redis_client.publish("new-reservations", json.dumps(reserv))
+    async with redis.redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(reservation_key(res_id), mapping=encode_reservation(reserv))
+        add_to_indexes(pipe, reserv)
+        add_event(pipe, "created", res_id, reserv)
+        await pipe.execute()
 
     return res_id
 
 async def get_reservation_by_id(res_id: str) -> dict | None:
-    data = await redis.redis_client.get(reservation_key(res_id))
-    if not data:
-        return None
-    return json.loads(data)
+    fields = await redis.redis_client.hgetall(reservation_key(res_id))
+    return decode_reservation(fields)
 
-async def get_iikoId_by_id(res_id: str) -> str | None:
-    data = await redis.redis_client.get(reservation_key(res_id))
-    if not data:
-        return None
+async def get_reservations_by_ids(res_ids: list[str]) -> list[dict]:
+    if not res_ids:
+        return []
+    async with redis.redis_client.pipeline(transaction=False) as pipe:
+        for res_id in res_ids:
+            pipe.hgetall(reservation_key(res_id))
+        rows = await pipe.execute()
+    return [decode_reservation(row) for row in rows if row]
 
-    reservation = json.loads(data)
-    return reservation.get("id_iiko")
+async def get_reservations_by_status(status: str, start: int = 0, end: int = -1) -> list[dict]:
+    res_ids = await redis.redis_client.zrange(status_index_key(status), start, end)
+    return await get_reservations_by_ids(res_ids)
 
+async def get_reservation_rank(status: str, res_id: str) -> int | None:
+    return await redis.redis_client.zrank(status_index_key(status), res_id)
 
-async def delete_reservation_by_id(res_id: str):
-    await redis.redis_client.delete(reservation_key(res_id))
+async def count_reservations_by_status(status: str) -> int:
+    return await redis.redis_client.zcard(status_index_key(status))
 
-async def update_reservation_status(res_id:str, new_status:str, id_iiko: str):
-    key = reservation_key(res_id)
+async def get_user_reservations(user_id: int, status: str) -> list[dict]:
+    res_ids = await redis.redis_client.zrange(user_index_key(user_id, status), 0, -1)
+    return await get_reservations_by_ids(res_ids)
 
-    data = await redis.redis_client.get(key)
-    if not data:
-        return False
-    
-    reservation = json.loads(data)
+async def delete_reservation_by_id(res_id: str, event: str = "cancelled", expected: str | None = None) -> bool:
+    # expected - удалить, только если заявка в этом статусе
+    while True:
+        status, user_id = await redis.redis_client.hmget(reservation_key(res_id), ["status", "user_id"])
+        if status is None:
+            return False
+        status = json.loads(status)
+        if expected is not None and status != expected:
+            return False
 
-    reservation["status"] = new_status
+        deleted = await script(DELETE_SCRIPT)(
+            keys=[
+                reservation_key(res_id), status_index_key(status),
+                user_index_key(json.loads(user_id), status)
+            ],
+            args=[res_id, json.dumps(status)]
+        )
+        # -1 - статус сменился между чтением и скриптом, перечитываем
+        if deleted != -1:
+            break
 
-    if id_iiko is not None:
-        reservation["id_iiko"] = id_iiko
-    await redis.redis_client.set(key, json.dumps(reservation))
-    return True
+    if deleted:
+        await publish_reservation_event(event, res_id)
+    return deleted == 1
 
-async def update_reservation_confirmation(res_id: str, status: str, message_id: int | None = None):
-    key = reservation_key(res_id)
+async def update_reservation_status(res_id:str, new_status:str, id_iiko: str | None = None, expected: str | None = None) -> bool:
+    fields = {"id_iiko": id_iiko} if id_iiko is not None else {}
+    while True:
+        current, user_id = await redis.redis_client.hmget(reservation_key(res_id), ["status", "user_id"])
+        if current is None:
+            return False
+        current = json.loads(current) if expected is None else expected
+        user_id = json.loads(user_id)
 
-    data = await redis.redis_client.get(key)
-    if not data:
-        return False
+        result = await script(TRANSITION_SCRIPT)(
+            keys=[
+                reservation_key(res_id), status_index_key(current), status_index_key(new_status),
+                user_index_key(user_id, current), user_index_key(user_id, new_status)
+            ],
+            args=[res_id, json.dumps(current), json.dumps(new_status), *encode_fields(fields)]
+        )
+        # без expected -1 значит, что статус сменился после чтения - пробуем с новым
+        if result != -1 or expected is not None:
+            break
 
-    reservation = json.loads(data)
+    if result == 1:
+        event = "approved" if new_status == "CONFIRMED" else "status_changed"
+        await publish_reservation_event(event, res_id, {"status": new_status})
+    return result == 1
 
-    reservation["confirmation_status"] = status
+async def set_reservation_fields(res_id: str, fields: dict, expected_status: str | None = None) -> bool:
+    # пишет поля, только если заявка есть и (если задан expected_status) в этом статусе
+    result = await script(COMPARE_AND_SET_SCRIPT)(
+        keys=[reservation_key(res_id)],
+        args=[
+            "status",
+            json.dumps(expected_status) if expected_status is not None else "",
+            *encode_fields(fields)
+        ]
+    )
+    return result == 1
 
+async def update_reservation_confirmation(res_id: str, status: str, message_id: int | None = None, expected: str | None = None) -> bool:
+    fields = {"confirmation_status": status}
     if message_id is not None:
-        reservation["confirmation_message_id"] = message_id
+        fields["confirmation_message_id"] = message_id
+
+    result = await script(COMPARE_AND_SET_SCRIPT)(
+        keys=[reservation_key(res_id)],
+        args=[
+            "confirmation_status",
+            json.dumps(expected) if expected is not None else "",
+            *encode_fields(fields)
+        ]
+    )
+    if result == 1:
+        await publish_reservation_event("confirmation", res_id, {"confirmation_status": status})
+    return result == 1
+
+async def migrate_reservation_records():
+    # Разовая миграция заявок из JSON-строк в hash'и
+    if await redis.redis_client.get(STORAGE_VERSION_KEY) == STORAGE_VERSION:
+        return
+
+    migrate = script(MIGRATE_SCRIPT)
+    async for key in redis.redis_client.scan_iter(match=reservation_key("*"), count=500, _type="string"):
+        await migrate(keys=[key])
+
+    await redis.redis_client.set(STORAGE_VERSION_KEY, STORAGE_VERSION)
+
+async def rebuild_reservation_indexes():
+    # Разовая миграция: заявки, созданные до индексов, лежат только в REQUESTS_LIST
+    if await redis.redis_client.get(INDEX_VERSION_KEY) == INDEX_VERSION:
+        return
+
+    # У старых заявок нет created_at, а очередь админа шла в порядке REQUESTS_LIST (rpush).
+    # Позиция в списке становится их created_at: порядок сохраняется, и все они раньше новых заявок
+    legacy = await redis.redis_client.lrange(REQUESTS_LIST, 0, -1)
+    positions = {}
+    for position, res_id in enumerate(legacy):
+        positions.setdefault(res_id, position)
+    res_ids = list(positions)
+    async for key in redis.redis_client.scan_iter(match=reservation_key("*"), count=500):
+        res_id = key.removeprefix(reservation_key(""))
+        if res_id not in positions:
+            positions[res_id] = len(legacy)
+            res_ids.append(res_id)
+
+    # индексы прошлых версий: общий по дате никто не читал, по пользователю - без статуса
+    await redis.redis_client.delete(LEGACY_DATETIME_INDEX)
+    async for key in redis.redis_client.scan_iter(match=LEGACY_USER_INDEX_PATTERN, count=500):
+        await redis.redis_client.delete(key)
+
+    for i in range(0, len(res_ids), 500):
+        reservations = await get_reservations_by_ids(res_ids[i:i + 500])
+        async with redis.redis_client.pipeline(transaction=False) as pipe:
+            for reservation in reservations:
+                if reservation.get("created_at") is None:
+                    reservation["created_at"] = positions[reservation["id"]]
+                    pipe.hset(reservation_key(reservation["id"]), "created_at", json.dumps(reservation["created_at"]))
+                add_to_indexes(pipe, reservation)
+            await pipe.execute()
 
-    await redis.redis_client.set(key, json.dumps(reservation))
-    return True
+    await redis.redis_client.set(INDEX_VERSION_KEY, INDEX_VERSION)
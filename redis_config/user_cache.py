@@ -0,0 +1,104 @@
+import os
+import time
+from collections import OrderedDict
+
+from redis.exceptions import ResponseError
+
+from monitoring.metrics import cache_result
+from redis_config import redis_client as redis
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+
+
+class UserStateCache:
+    # Локальная копия анкеты бронирования reservation:{user_id}. Запись всегда идёт сразу
+    # в Redis, а изменения с других реплик приходят через keyspace notifications
+
+    def __init__(self, max_size: int = USER_CACHE_SIZE):
+        self.max_size = max_size
+        # key -> (когда истекает, data)
+        self._entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        # собственные записи, уведомления о которых не должны сбрасывать кеш
+        self._own_writes: dict[str, int] = {}
+        # без подписки уведомлений не будет и отметки копились бы бесконечно
+        self.listening = False
+
+    def get(self, key: str) -> dict | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            cache_result("user_state", "miss")
+            return None
+        if entry[0] <= time.monotonic():
+            del self._entries[key]
+            cache_result("user_state", "miss")
+            return None
+        self._entries.move_to_end(key)
+        cache_result("user_state", "hit")
+        # копия: обработчики меняют словарь до set_user_data
+        return dict(entry[1])
+
+    def put(self, key: str, data: dict, ttl: float):
+        self._entries[key] = (time.monotonic() + ttl, dict(data))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: str):
+        self._entries.pop(key, None)
+
+    def mark_own_write(self, key: str):
+        if not self.listening:
+            return
+        self._own_writes[key] = self._own_writes.get(key, 0) + 1
+
+    def unmark_own_write(self, key: str) -> bool:
+        # False - отметки не было
+        pending = self._own_writes.get(key, 0)
+        if not pending:
+            return False
+        if pending == 1:
+            del self._own_writes[key]
+        else:
+            self._own_writes[key] = pending - 1
+        return True
+
+    def on_notification(self, key: str, event: str):
+        # SET ... EX шлёт set и следом expire; сброс делает set, а истечение приходит как expired
+        if event == "expire":
+            return
+        if event != "expired" and self.unmark_own_write(key):
+            return
+        self.invalidate(key)
+
+    async def listen_invalidations(self, pattern: str):
+        client = redis.redis_client
+        try:
+            # g - del, $ - set, x - expired; флаги, включённые кем-то ещё, сохраняем.
+            # На управляемом Redis команда может быть запрещена
+            current = (await client.config_get("notify-keyspace-events")).get("notify-keyspace-events", "")
+            # A - псевдоним для всех классов событий, включая g, $ и x
+            missing = "".join(
+                flag for flag in "Kg$x"
+                if flag not in current and not (flag != "K" and "A" in current)
+            )
+            if missing:
+                await client.config_set("notify-keyspace-events", current + missing)
+        except ResponseError as e:
+            print(f"Не удалось включить keyspace notifications: {e}")
+
+        db = client.connection_pool.connection_kwargs.get("db", 0)
+        prefix = f"__keyspace@{db}__:"
+        pubsub = client.pubsub()
+        await pubsub.psubscribe(prefix + pattern)
+        self.listening = True
+        try:
+            async for message in pubsub.listen():
+                if message["type"] == "pmessage":
+                    self.on_notification(message["channel"].removeprefix(prefix), message["data"])
+        finally:
+            self.listening = False
+            self._own_writes.clear()
+            await pubsub.aclose()
+
+
+user_state_cache = UserStateCache()